@@ -0,0 +1,144 @@
+"""在本地模拟的 WebUI 上测量后端准入控制对延迟的影响
+
+模拟服务器同一时间只执行一个生成任务，并通过 /sdapi/v1/progress 报告 job_count 与预计剩余时间。
+场景为若干 LLM 工具任务同时排队后，稍晚到达一条用户指令，分别在关闭与开启后端准入时运行，
+输出指令与工具任务的端到端耗时、进度查询次数，以及排队深度的峰值。
+需在安装了 AstrBot 的 Python 环境中运行：
+
+    python bench/admission_bench.py --tools 5 --generation-seconds 0.4
+"""
+import argparse
+import asyncio
+import base64
+import statistics
+import time
+
+from aiohttp import web
+
+from common import make_generator
+
+
+class BenchEvent:
+    """最小化的消息事件，只实现生成流程用到的接口"""
+    unified_msg_origin = "bench"
+    message_str = ""
+
+    def get_platform_name(self):
+        return "bench"
+
+    def get_sender_id(self):
+        return "user"
+
+    def get_group_id(self):
+        return ""
+
+    def is_admin(self):
+        return False
+
+    def get_messages(self):
+        return []
+
+    def plain_result(self, text):
+        return text
+
+    def chain_result(self, chain):
+        return chain
+
+
+async def start_stub_webui(port: int, generation_seconds: float) -> web.AppRunner:
+    """启动模拟的 WebUI：txt2img 串行执行，progress 报告当前任务"""
+    lock = asyncio.Lock()
+    state = {"job_count": 0, "ends_at": 0.0}
+
+    async def txt2img(request):
+        await request.json()
+        async with lock:
+            state["job_count"] = 1
+            state["ends_at"] = time.monotonic() + generation_seconds
+            await asyncio.sleep(generation_seconds)
+            state["job_count"] = 0
+        return web.json_response({"images": [base64.b64encode(b"bench").decode()], "info": "{}"})
+
+    async def progress(request):
+        busy = state["job_count"] > 0
+        return web.json_response({
+            "progress": 0,
+            "eta_relative": max(0.0, state["ends_at"] - time.monotonic()) if busy else 0,
+            "state": {"job_count": state["job_count"], "job": "txt2img" if busy else ""},
+        })
+
+    app = web.Application()
+    app.router.add_post("/sdapi/v1/txt2img", txt2img)
+    app.router.add_get("/sdapi/v1/progress", progress)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+async def scenario(args, enable: bool) -> dict:
+    generator = make_generator(
+        webui_url=f"http://127.0.0.1:{args.port}",
+        backend_admission={"enable": enable},
+        show_generation_info="never",
+        verbose=False,
+        enable_upscale=False,
+    )
+    event = BenchEvent()
+    latencies = {}
+    peak_depth = 0
+
+    async def job(name: str, lane: str):
+        started = time.monotonic()
+        async for _ in generator._run_generate_image(
+            event, name, allow_generate_prompt=False, allow_extract_prompt=False, lane=lane
+        ):
+            pass
+        latencies[name] = time.monotonic() - started
+
+    async def sample_depth():
+        nonlocal peak_depth
+        while True:
+            peak_depth = max(peak_depth, generator._queue_depth())
+            await asyncio.sleep(0.01)
+
+    sampler = asyncio.create_task(sample_depth())
+    tools = [asyncio.create_task(job(f"tool{i}", "tool")) for i in range(args.tools)]
+    await asyncio.sleep(args.command_delay)
+    await job("command", "command")
+    await asyncio.gather(*tools)
+    sampler.cancel()
+
+    result = {
+        "command": latencies["command"],
+        "tools": [latencies[f"tool{i}"] for i in range(args.tools)],
+        "polls": generator.metrics["backend_polls"],
+        "peak_depth": peak_depth,
+    }
+    await generator.terminate()
+    return result
+
+
+async def run(args):
+    runner = await start_stub_webui(args.port, args.generation_seconds)
+    try:
+        print(f"模拟 WebUI：串行执行，每张 {args.generation_seconds} 秒；"
+              f"{args.tools} 个 LLM 工具任务排队后 {args.command_delay} 秒到达一条用户指令")
+        for enable in (False, True):
+            result = await scenario(args, enable)
+            print(
+                f"- 后端准入{'开启' if enable else '关闭'}: 指令 {result['command']:.2f} 秒，"
+                f"工具任务平均 {statistics.mean(result['tools']):.2f} 秒（最大 {max(result['tools']):.2f} 秒），"
+                f"进度查询 {result['polls']} 次，排队深度峰值 {result['peak_depth']}"
+            )
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--tools", type=int, default=5, help="排队的 LLM 工具任务数")
+    parser.add_argument("--command-delay", type=float, default=0.1, help="用户指令晚于工具任务到达的秒数")
+    parser.add_argument("--generation-seconds", type=float, default=0.4, help="模拟的单张生成耗时")
+    parser.add_argument("--port", type=int, default=7861, help="模拟 WebUI 监听的端口")
+    asyncio.run(run(parser.parse_args()))
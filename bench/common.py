@@ -0,0 +1,48 @@
+"""基准测试脚本的公共部分：在安装了 AstrBot 的 Python 环境中加载插件，并以配置默认值构造 SDGenerator"""
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import main  # noqa: E402
+
+
+class BenchConfig(dict):
+    """仅供基准测试使用的配置，不写回磁盘"""
+
+    def save_config(self):
+        pass
+
+
+def schema_defaults(schema: dict) -> dict:
+    """按 _conf_schema.json 生成默认配置"""
+    config = {}
+    for key, item in schema.items():
+        if item.get("type") == "object":
+            config[key] = schema_defaults(item.get("items", {}))
+        else:
+            config[key] = item.get("default")
+    return config
+
+
+def make_generator(**overrides) -> main.SDGenerator:
+    """构造关闭了预热、事件循环监控与历史记录的 SDGenerator，需在事件循环中调用
+
+    overrides 中的对象类配置会与默认值合并，其余直接覆盖。
+    """
+    with open(os.path.join(ROOT, "_conf_schema.json"), encoding="utf-8") as f:
+        config = schema_defaults(json.load(f))
+    overrides = {
+        "warm_up": {"enable": False},
+        "loop_monitor": {"enable": False},
+        "history": {"size": 0},
+        **overrides,
+    }
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(config.get(key), dict):
+            config[key] = {**config[key], **value}
+        else:
+            config[key] = value
+    return main.SDGenerator(None, BenchConfig(config))
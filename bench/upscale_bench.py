@@ -0,0 +1,88 @@
+"""对比本地 CPU 与 WebUI 两条放大路径的延迟与吞吐
+
+需在安装了 AstrBot 与 Pillow 的 Python 环境中运行。WebUI 路径会直接向后端发送放大请求，
+不经过插件的准入队列，请避开使用高峰，或使用 --local-only 只测试本地路径。
+
+    python bench/upscale_bench.py --webui http://127.0.0.1:7860 --upscaler "R-ESRGAN 4x+" --runs 4
+"""
+import argparse
+import asyncio
+import base64
+import io
+import time
+
+from common import main, make_generator
+
+
+def synthesize_test_image(size: int) -> str:
+    """生成一张噪声测试图片（base64）"""
+    output = io.BytesIO()
+    main.PILImage.effect_noise((size, size), 64).convert("RGB").save(output, format="PNG")
+    return base64.b64encode(output.getvalue()).decode("utf-8")
+
+
+async def measure(upscale, image: str, runs: int, concurrency: int) -> (list, float):
+    """顺序执行 runs 次测量单张延迟，再以 concurrency 的并发执行 runs 次测量吞吐"""
+    latencies = []
+    for _ in range(runs):
+        started = time.monotonic()
+        await upscale(image)
+        latencies.append(time.monotonic() - started)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited():
+        async with semaphore:
+            await upscale(image)
+
+    started = time.monotonic()
+    await asyncio.gather(*(limited() for _ in range(runs)))
+    return latencies, runs / (time.monotonic() - started)
+
+
+async def run(args):
+    if main.PILImage is None:
+        raise SystemExit("需要安装 Pillow")
+    if args.image:
+        with open(args.image, "rb") as f:
+            image = base64.b64encode(f.read()).decode("utf-8")
+    else:
+        image = synthesize_test_image(args.size)
+
+    generator = make_generator(
+        webui_url=args.webui,
+        default_params={"upscaler": args.upscaler, "upscale_factor": args.factor},
+        cpu_upscale={"sharpen": not args.no_sharpen, "workers": args.workers},
+    )
+    paths = [("本地", generator._upscale_locally)]
+    if not args.local_only:
+        # 与插件一致：未设置或为 None 的上采样算法在 WebUI 上以 Lanczos 对照
+        upscaler = args.upscaler if args.upscaler not in ("", "None") else "Lanczos"
+        paths.append(("WebUI", lambda data: generator._upscale_with_webui(data, upscaler)))
+
+    print(f"放大基准测试：{args.image or f'{args.size}x{args.size} 噪声图片'}，{args.factor} 倍，"
+          f"上采样算法 {args.upscaler or '未设置'}，顺序与并发各 {args.runs} 次")
+    try:
+        for name, upscale in paths:
+            latencies, throughput = await measure(upscale, image, args.runs, args.concurrency)
+            print(
+                f"- {name}: 平均延迟 {sum(latencies) / len(latencies):.2f} 秒（最大 {max(latencies):.2f} 秒），"
+                f"并发 {args.concurrency} 吞吐 {throughput:.2f} 张/秒"
+            )
+    finally:
+        await generator.terminate()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--webui", default="http://127.0.0.1:7860", help="WebUI API 地址")
+    parser.add_argument("--upscaler", default="", help="WebUI 路径使用的上采样算法")
+    parser.add_argument("--factor", type=int, default=2, help="放大倍数")
+    parser.add_argument("--image", help="测试图片路径，默认使用噪声图片")
+    parser.add_argument("--size", type=int, default=512, help="噪声图片边长")
+    parser.add_argument("--runs", type=int, default=4, help="顺序与并发各执行的次数")
+    parser.add_argument("--concurrency", type=int, default=2, help="吞吐测试的并发数")
+    parser.add_argument("--workers", type=int, default=1, help="本地放大工作进程数")
+    parser.add_argument("--no-sharpen", action="store_true", help="本地放大不叠加 USM 锐化")
+    parser.add_argument("--local-only", action="store_true", help="只测试本地路径")
+    asyncio.run(run(parser.parse_args()))
@@ -1,13 +1,573 @@
+import abc
 import asyncio
+import base64
+import functools
+import gzip
+import hashlib
+import heapq
+import html
+import io
+import json
 import os
+import random
 import re
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager, closing
 
 import aiohttp
 
 from astrbot.api.all import *
+from astrbot.api.event.filter import PermissionType, permission_type
+
+try:
+    from PIL import Image as PILImage, ImageFilter, ImageOps
+except ImportError:  # Pillow 为可选依赖，缺失时图生图直接上传原图、放大只走 WebUI
+    PILImage = None
 
 
 TEMP_PATH = os.path.abspath("data/temp")
+HISTORY_PATH = os.path.join(TEMP_PATH, "sdgen_history")  # 本插件独占，加载时清空
+JOB_QUEUE_PATH = os.path.abspath("data/sdgen_job_queue.db")
+
+# 资源类型对应的 WebUI 接口
+RESOURCE_TYPES = {
+    "model": "/sdapi/v1/sd-models",
+    "embedding": "/sdapi/v1/embeddings",
+    "lora": "/sdapi/v1/loras",
+    "sampler": "/sdapi/v1/samplers",
+    "upscaler": "/sdapi/v1/upscalers"
+}
+
+# /sd gen 支持的单次生成参数（--参数名 取值），不会修改全局配置
+VALUE_OVERRIDE_OPTIONS = {
+    "--size": "size",
+    "--steps": "steps",
+    "--seed": "seed",
+    "--batch": "batch_size",
+    "--sampler": "sampler",
+}
+FLAG_OVERRIDE_OPTIONS = {
+    "--draft": ("draft", True),
+    "--upscale": ("upscale", True),
+    "--no-upscale": ("upscale", False),
+}
+
+MAX_DRAFT_SESSIONS = 256  # 最多保留草稿记录的会话数，超出时移除最久未使用的会话
+
+# 本地 CLIP 分词：WebUI 按每 75 个 token 一块进行条件编码，多出一块就多一份 GPU 计算
+CLIP_VOCAB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bpe_simple_vocab_16e6.txt.gz")
+CLIP_CHUNK_TOKENS = 75
+CLIP_TOKEN_PATTERN = re.compile(r"'s|'t|'re|'ve|'m|'ll|'d|[^\W\d_]+|\d|(?:[^\s\w]|_)+", re.IGNORECASE)
+# WebUI 的提示词控制关键字（需大写）：BREAK 强制开始新的分块，AND 分隔组合提示词中各自独立编码的子提示词
+PROMPT_CONTROL_PATTERN = re.compile(r"\b(BREAK|AND)\b")
+PROMPT_SYNTAX_PATTERN = re.compile(r"<[^>]*>|:\s*-?[\d.]+\s*(?=[)\]])|(?<!\\)[()\[\]]")
+
+
+def _bytes_to_unicode() -> dict:
+    """CLIP 使用的字节到可见 unicode 字符映射"""
+    bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(2 ** 8):
+        if b not in bs:
+            bs.append(b)
+            cs.append(2 ** 8 + n)
+            n += 1
+    return dict(zip(bs, map(chr, cs)))
+
+
+class ClipTokenizer:
+    """CLIP BPE 分词器（移植自 OpenAI CLIP 的 simple_tokenizer），仅用于在本地统计 token 数"""
+    _instance = None
+    _unavailable = False
+
+    def __init__(self, vocab_path: str = CLIP_VOCAB_PATH):
+        with gzip.open(vocab_path) as f:
+            merges = f.read().decode("utf-8").split("\n")[1:49152 - 256 - 2 + 1]
+        self.bpe_ranks = {tuple(merge.split()): i for i, merge in enumerate(merges)}
+        self.byte_encoder = _bytes_to_unicode()
+
+    @classmethod
+    def get(cls):
+        """获取共享实例，词表缺失时返回 None 并退回近似统计"""
+        if cls._instance is None and not cls._unavailable:
+            try:
+                cls._instance = cls()
+            except OSError as e:
+                logger.warning(f"加载 CLIP 词表失败，将使用近似的 token 统计: {e}")
+                cls._unavailable = True
+        return cls._instance
+
+    @functools.lru_cache(maxsize=8192)
+    def _bpe_length(self, token: str) -> int:
+        """返回单词经过 BPE 合并后的 token 数"""
+        word = tuple(token[:-1]) + (token[-1] + "</w>",)
+        while len(word) > 1:
+            pairs = set(zip(word, word[1:]))
+            bigram = min(pairs, key=lambda pair: self.bpe_ranks.get(pair, float("inf")))
+            if bigram not in self.bpe_ranks:
+                break
+            first, second = bigram
+            merged = []
+            i = 0
+            while i < len(word):
+                if i < len(word) - 1 and word[i] == first and word[i + 1] == second:
+                    merged.append(first + second)
+                    i += 2
+                else:
+                    merged.append(word[i])
+                    i += 1
+            word = tuple(merged)
+        return len(word)
+
+    @functools.lru_cache(maxsize=8192)
+    def count_tokens(self, text: str) -> int:
+        text = " ".join(html.unescape(text).split()).lower()
+        return sum(
+            self._bpe_length("".join(self.byte_encoder[b] for b in token.encode("utf-8")))
+            for token in CLIP_TOKEN_PATTERN.findall(text)
+        )
+
+
+MAX_HISTORY_SESSIONS = 256
+MAX_PREPROCESS_CACHE = 32
+
+
+def _preprocess_image(data: bytes, width: int, height: int, keep_aspect: bool) -> (bytes, int, int):
+    """在工作进程中将上传的图片缩小并重新编码到目标分辨率
+
+    keep_aspect 为真时按原图比例计算不超过 width×height 像素的目标尺寸，否则直接使用给定尺寸。
+    返回编码后的图片与最终宽高（均为 8 的倍数）。
+    """
+    with PILImage.open(io.BytesIO(data)) as source:
+        image = ImageOps.exif_transpose(source).convert("RGB")
+
+    if keep_aspect:
+        scale = min(1.0, (width * height / (image.width * image.height)) ** 0.5)
+        width, height = image.width * scale, image.height * scale
+    width = max(64, int(width) // 8 * 8)
+    height = max(64, int(height) // 8 * 8)
+
+    if image.width > width or image.height > height:
+        # 先按比例缩小到覆盖目标尺寸，由 WebUI 按 resize_mode=1 居中裁剪，避免上传和显存浪费
+        cover = max(width / image.width, height / image.height)
+        image = image.resize(
+            (max(1, round(image.width * cover)), max(1, round(image.height * cover))),
+            PILImage.LANCZOS
+        )
+
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=95)
+    return output.getvalue(), width, height
+
+
+# 纯插值类的上采样算法，在本地 CPU 上放大的效果与 WebUI 一致
+LOCAL_UPSCALERS = {"", "None", "Lanczos", "Nearest"}
+
+
+def _upscale_image_local(data: bytes, factor: float, upscaler: str, sharpen: bool) -> bytes:
+    """在工作进程中按倍数插值放大图片，可选叠加 USM 锐化，返回 PNG 编码结果"""
+    with PILImage.open(io.BytesIO(data)) as source:
+        image = source.convert("RGB")
+
+    size = (max(1, round(image.width * factor)), max(1, round(image.height * factor)))
+    resample = PILImage.NEAREST if upscaler == "Nearest" else PILImage.LANCZOS
+    image = image.resize(size, resample)
+    if sharpen:
+        image = image.filter(ImageFilter.UnsharpMask(radius=2, percent=80, threshold=2))
+
+    output = io.BytesIO()
+    image.save(output, format="PNG")
+    return output.getvalue()
+
+
+class ImageInfo:
+    """单张图片的实际生成参数，取自 WebUI 返回的 info，缺失的字段为 None"""
+    __slots__ = ("seed", "subseed", "sampler", "steps", "model_hash")
+
+    def __init__(self, seed=None, subseed=None, sampler=None, steps=None, model_hash=None):
+        self.seed = seed
+        self.subseed = subseed
+        self.sampler = sampler
+        self.steps = steps
+        self.model_hash = model_hash
+
+    def describe(self) -> str:
+        """格式化为附在结果消息后的一行说明"""
+        parts = []
+        if self.seed is not None:
+            parts.append(f"种子 {self.seed}" + (f"（子种子 {self.subseed}）" if self.subseed is not None else ""))
+        if self.sampler:
+            parts.append(self.sampler)
+        if self.steps is not None:
+            parts.append(f"{self.steps} 步")
+        if self.model_hash:
+            parts.append(f"模型 {self.model_hash}")
+        return "，".join(parts)
+
+
+class GenerationInfo:
+    """WebUI 返回的 info JSON，首次访问时才解析，同一批次的图片共享一个实例"""
+    __slots__ = ("raw", "_images")
+
+    def __init__(self, raw: str):
+        self.raw = raw or ""
+        self._images = None
+
+    def image(self, index: int) -> ImageInfo:
+        """获取批次中第 index 张图片的实际生成参数"""
+        if self._images is None:
+            self._images = self._parse()
+        if index < len(self._images):
+            return self._images[index]
+        return ImageInfo()
+
+    def _parse(self) -> list:
+        try:
+            info = json.loads(self.raw)
+        except ValueError:
+            return []
+        if not isinstance(info, dict):
+            return []
+
+        seeds = info.get("all_seeds") or [info.get("seed")]
+        subseeds = info.get("all_subseeds") or [info.get("subseed")]
+        images = []
+        for i, seed in enumerate(seeds):
+            subseed = subseeds[i] if i < len(subseeds) else None
+            images.append(ImageInfo(
+                seed,
+                # 未启用变异种子时子种子不影响结果，不再展示
+                subseed if info.get("subseed_strength") else None,
+                info.get("sampler_name"),
+                info.get("steps"),
+                info.get("sd_model_hash"),
+            ))
+        return images
+
+
+class GenerationRecord:
+    """一张已生成图片的历史记录，图片缓存在临时目录中"""
+    __slots__ = ("prompt", "payload", "info", "index", "image_path", "created_at")
+
+    def __init__(self, prompt: str, payload: dict, info: GenerationInfo, index: int, image_path: str):
+        self.prompt = prompt
+        self.payload = payload
+        self.info = info
+        self.index = index  # 在所属批次中的序号
+        self.image_path = image_path
+        self.created_at = time.time()
+
+    @property
+    def details(self) -> ImageInfo:
+        return self.info.image(self.index)
+
+    @property
+    def seed(self) -> int:
+        """图片的实际种子，info 缺失时按 WebUI 的规则由请求种子推算"""
+        seed = self.details.seed
+        if seed is None:
+            seed = self.payload["seed"] + self.index if self.payload["seed"] != -1 else -1
+        return seed
+
+    def remove_image(self):
+        try:
+            os.remove(self.image_path)
+        except OSError:
+            pass
+
+
+# 准入调度的优先级通道（数值越小越优先），排队每满 aging_seconds 秒视为提升一级，低优先级任务不会饿死
+JOB_LANES = {
+    "admin": ("管理员", 0),
+    "command": ("指令", 1),
+    "tool": ("LLM工具", 2),
+    "warm_up": ("预热", 3),
+}
+DEFAULT_AGING_SECONDS = 30
+
+
+class JobQueue(abc.ABC):
+    """生成任务的准入队列接口，决定任务何时可以占用 WebUI 生成槽位
+
+    任务按 入队时间 + 通道优先级 × aging_seconds 的排名调度：高优先级通道严格优先，
+    但低优先级任务每多等待 aging_seconds 秒就相当于提升一级。
+    """
+
+    def __init__(self, limit: int, priorities: dict = None, aging_seconds: float = DEFAULT_AGING_SECONDS):
+        self.limit = limit
+        self.priorities = {lane: priority for lane, (_, priority) in JOB_LANES.items()}
+        self.priorities.update(priorities or {})
+        self.aging_seconds = aging_seconds
+
+    def _rank(self, lane: str, enqueued_at: float) -> float:
+        return enqueued_at + self.priorities.get(lane, self.priorities["command"]) * self.aging_seconds
+
+    @abc.abstractmethod
+    async def acquire(self, job_id: str, lane: str = "command"):
+        """排队直到任务获得生成槽位"""
+
+    @abc.abstractmethod
+    async def release(self, job_id: str):
+        """释放任务占用的槽位，未获得槽位的任务则移出队列"""
+
+    @abc.abstractmethod
+    async def stats(self) -> dict:
+        """返回 {"active": 运行中任务数, "queued": 排队任务数}"""
+
+    async def close(self):
+        pass
+
+
+class InProcessJobQueue(JobQueue):
+    """进程内准入队列，仅限制当前 AstrBot 实例的并发"""
+
+    def __init__(self, limit: int, priorities: dict = None, aging_seconds: float = DEFAULT_AGING_SECONDS):
+        super().__init__(limit, priorities, aging_seconds)
+        self.active = 0
+        self.waiters = []  # (排名, 序号, future) 小顶堆
+        self.counter = 0
+
+    async def acquire(self, job_id: str, lane: str = "command"):
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self.counter += 1
+        heapq.heappush(self.waiters, (self._rank(lane, time.monotonic()), self.counter, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 槽位已分配但任务被取消，转交给下一个任务
+                await self.release(job_id)
+            else:
+                self.waiters = [waiter for waiter in self.waiters if waiter[2] is not future]
+                heapq.heapify(self.waiters)
+            raise
+
+    async def release(self, job_id: str):
+        self.active -= 1
+        while self.waiters and self.active < self.limit:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                self.active += 1
+                future.set_result(None)
+
+    async def stats(self) -> dict:
+        return {"active": self.active, "queued": len(self.waiters)}
+
+
+class SQLiteJobQueue(JobQueue):
+    """基于 SQLite 的跨进程准入队列，同一主机上的多个 AstrBot 实例共享并发上限
+
+    空闲槽位优先分配给运行中任务最少的实例，同一实例内按优先级通道与排队时间排名，实现实例间的公平调度。
+    任务持有期间定期刷新心跳，崩溃实例遗留的任务在超时后自动清除。
+    """
+    POLL_INTERVAL = 0.5
+    HEARTBEAT_INTERVAL = 5
+    STALE_TIMEOUT = 30
+
+    def __init__(self, path: str, limit: int, priorities: dict = None, aging_seconds: float = DEFAULT_AGING_SECONDS):
+        super().__init__(limit, priorities, aging_seconds)
+        self.path = path
+        self.instance = f"{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.jobs = set()  # 本实例排队或运行中的任务
+        self.wakeup = asyncio.Event()
+        self.heartbeat_task = None
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "job_id TEXT PRIMARY KEY, instance TEXT NOT NULL, state TEXT NOT NULL, "
+                "enqueued_at REAL NOT NULL, heartbeat REAL NOT NULL, "
+                "lane TEXT NOT NULL DEFAULT 'command', rank REAL NOT NULL DEFAULT 0)"
+            )
+            # 兼容旧版本创建的队列文件
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "lane" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN lane TEXT NOT NULL DEFAULT 'command'")
+            if "rank" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN rank REAL NOT NULL DEFAULT 0")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _insert(self, conn: sqlite3.Connection, job_id: str, lane: str, enqueued_at: float, now: float):
+        conn.execute(
+            "INSERT INTO jobs (job_id, instance, state, enqueued_at, heartbeat, lane, rank) "
+            "VALUES (?, ?, 'queued', ?, ?, ?, ?)",
+            (job_id, self.instance, enqueued_at, now, lane, self._rank(lane, enqueued_at))
+        )
+
+    def _enqueue(self, job_id: str, lane: str) -> float:
+        now = time.time()
+        with closing(self._connect()) as conn:
+            self._insert(conn, job_id, lane, now, now)
+        return now
+
+    def _try_acquire(self, job_id: str, lane: str, enqueued_at: float) -> bool:
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM jobs WHERE heartbeat < ?", (now - self.STALE_TIMEOUT,))
+                if conn.execute("UPDATE jobs SET heartbeat = ? WHERE job_id = ?", (now, job_id)).rowcount == 0:
+                    # 心跳曾长时间未刷新（如事件循环被阻塞），本任务的排队记录已被当作崩溃遗留清除；
+                    # 按原排队时间重新登记，否则永远轮询不到自己
+                    logger.warning(f"共享队列中的排队任务 {job_id} 已被清除，按原排队时间重新登记")
+                    self._insert(conn, job_id, lane, enqueued_at, now)
+                active = conn.execute("SELECT COUNT(*) FROM jobs WHERE state = 'active'").fetchone()[0]
+                acquired = False
+                if active < self.limit:
+                    rows = conn.execute(
+                        "SELECT q.job_id FROM jobs q WHERE q.state = 'queued' ORDER BY "
+                        "(SELECT COUNT(*) FROM jobs a WHERE a.state = 'active' AND a.instance = q.instance), "
+                        "q.rank LIMIT ?",
+                        (self.limit - active,)
+                    ).fetchall()
+                    if any(row[0] == job_id for row in rows):
+                        conn.execute("UPDATE jobs SET state = 'active' WHERE job_id = ?", (job_id,))
+                        acquired = True
+                conn.execute("COMMIT")
+                return acquired
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _delete(self, job_ids: list):
+        with closing(self._connect()) as conn:
+            conn.executemany("DELETE FROM jobs WHERE job_id = ?", [(job_id,) for job_id in job_ids])
+
+    def _touch(self, job_ids: list):
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.executemany("UPDATE jobs SET heartbeat = ? WHERE job_id = ?", [(now, job_id) for job_id in job_ids])
+
+    def _count(self) -> dict:
+        with closing(self._connect()) as conn:
+            counts = dict(conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+        return {"active": counts.get("active", 0), "queued": counts.get("queued", 0)}
+
+    async def _heartbeat(self):
+        while self.jobs:
+            await asyncio.sleep(self.HEARTBEAT_INTERVAL)
+            try:
+                await asyncio.to_thread(self._touch, list(self.jobs))
+            except sqlite3.Error as e:
+                logger.warning(f"刷新共享队列心跳失败: {e}")
+
+    async def acquire(self, job_id: str, lane: str = "command"):
+        enqueued_at = await asyncio.to_thread(self._enqueue, job_id, lane)
+        self.jobs.add(job_id)
+        if self.heartbeat_task is None or self.heartbeat_task.done():
+            self.heartbeat_task = asyncio.create_task(self._heartbeat())
+        try:
+            while not await asyncio.to_thread(self._try_acquire, job_id, lane, enqueued_at):
+                # 本实例释放槽位时立即重试，其他实例释放的槽位靠轮询发现
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            await self.release(job_id)
+            raise
+
+    async def release(self, job_id: str):
+        self.jobs.discard(job_id)
+        await asyncio.to_thread(self._delete, [job_id])
+        self.wakeup.set()
+
+    async def stats(self) -> dict:
+        return await asyncio.to_thread(self._count)
+
+    async def close(self):
+        if self.heartbeat_task and not self.heartbeat_task.done():
+            self.heartbeat_task.cancel()
+        if self.jobs:
+            await asyncio.to_thread(self._delete, list(self.jobs))
+            self.jobs.clear()
+
+
+PLUGIN_FILE = os.path.abspath(__file__)
+
+
+def _sample_thread_stacks(thread_id: int, seconds: float, interval: float) -> (Counter, int):
+    """在独立线程中周期性采样目标线程（事件循环线程）的调用栈
+
+    返回以 (本插件中最内层的函数, 栈顶函数) 为键的采样计数，以及总采样次数。
+    事件循环空闲或在运行其他插件代码时，栈中没有本插件的帧，不计入热点。
+    """
+    hot_spots = Counter()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        samples += 1
+        leaf = frame
+        while frame is not None:
+            if os.path.abspath(frame.f_code.co_filename) == PLUGIN_FILE:
+                hot_spots[(
+                    f"{frame.f_code.co_name}@{frame.f_code.co_firstlineno}",
+                    f"{os.path.basename(leaf.f_code.co_filename)}:{leaf.f_code.co_name}",
+                )] += 1
+                break
+            frame = frame.f_back
+        time.sleep(interval)
+    return hot_spots, samples
+
+
+# GPU 成本单位：1.0 = 一张 512x512、20 步的图片
+BASE_COST_PIXELS = 512 * 512
+BASE_COST_STEPS = 20
+UPSCALE_COST_WEIGHT = 0.1  # 放大相对采样的单位像素成本
+MAX_QUOTA_BUCKETS = 1024
+
+# 负载降级各级别依次叠加的措施
+DEGRADATION_STAGES = ("跳过图像增强", "限制步数", "限制分辨率", "限制批数量")
+LATENCY_EWMA_ALPHA = 0.2
+
+
+class TokenBucket:
+    """以 GPU 成本计量的令牌桶"""
+    __slots__ = ("capacity", "refill_rate", "tokens", "updated")
+
+    def __init__(self, capacity: float, refill_rate: float):
+        self.capacity = capacity
+        self.refill_rate = refill_rate  # 每秒恢复的成本
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_rate)
+        self.updated = now
+
+    def wait_time(self, cost: float) -> float:
+        """距离可扣除 cost 还需等待的秒数，0 表示当前即可扣除"""
+        self.refill()
+        if self.tokens >= cost:
+            return 0.0
+        if self.refill_rate <= 0:
+            return float("inf")
+        return (cost - self.tokens) / self.refill_rate
+
+    def consume(self, cost: float):
+        self.refill()
+        self.tokens -= cost
+
+    def refund(self, cost: float):
+        self.refill()
+        self.tokens = min(self.capacity, self.tokens + cost)
+
 
 @register("SDGen", "buding(AstrBot)", "Stable Diffusion图像生成器", "1.2.2")
 class SDGenerator(Star):
@@ -17,11 +577,62 @@ class SDGenerator(Star):
         self.session = None
         self._validate_config()
         os.makedirs(TEMP_PATH, exist_ok=True)
+        self._clear_history_files()
 
         # 初始化并发控制
         self.active_tasks = 0
         self.max_concurrent_tasks = config.get("max_concurrent_tasks", 10)  # 设定最大并发数
-        self.task_semaphore = asyncio.Semaphore(self.max_concurrent_tasks)
+        self.job_queue = self._create_job_queue()
+        # 图像发送单独限流，不占用生成槽位
+        self.delivery_semaphore = asyncio.Semaphore(config.get("max_concurrent_deliveries", 5))
+
+        # 每个会话最近一次草稿生成的记录，用于 /sd promote，最近使用的会话排在最后
+        self.draft_records = OrderedDict()
+
+        # 按用户/群组划分的 GPU 成本令牌桶
+        self.quota_buckets = {}
+
+        # 负载状态与运行统计
+        self.queued_tasks = 0  # 等待并发槽位的任务数
+        self.lane_stats = {
+            lane: {"queued": 0, "jobs": 0, "wait_ewma": 0.0, "wait_max": 0.0} for lane in JOB_LANES
+        }
+
+        # 后端准入：任务在本插件内排队，直到 WebUI 报告空闲才发出，期间仍可取消与调整顺序
+        self.dispatch_queue = InProcessJobQueue(
+            1, self.job_queue.priorities, self.job_queue.aging_seconds
+        )
+        self.backend_inflight = 0  # 已发往 WebUI 尚未返回的生成请求数
+        self.backend_waiting = 0  # 已占用并发槽位、仍在等待 WebUI 空闲的任务数
+        self.backend_idle = asyncio.Event()  # 本插件的请求返回时唤醒等待中的任务
+        self.backend_wait_ewma = 0.0
+        self.latency_ewma = 0.0  # 任务从受理到出图耗时的滑动平均
+        self.metrics = Counter()
+
+        # 事件循环延迟监控，在后台低频采样调度延迟
+        self.loop_lag = {"last": 0.0, "ewma": 0.0, "max": 0.0}
+        self.loop_monitor_task = None
+        if config.get("loop_monitor", {}).get("enable", True):
+            self.loop_monitor_task = asyncio.create_task(self._monitor_loop_lag())
+
+        # 每个会话最近生成的图片，用于 /sd again、/sd upscale N、/sd vary N
+        self.history = OrderedDict()
+        # 按除种子外的文生图参数索引历史图片，相同参数与种子的请求直接复用
+        self.result_index = {}
+
+        # 图生图预处理与本地放大共用的工作进程池，按需创建；预处理结果按内容哈希缓存
+        self.process_pool = None
+        self.preprocess_cache = OrderedDict()
+
+        # 放大耗时的滑动平均，按本地与 WebUI 两条路径分别统计
+        self.upscale_latency = {"local": 0.0, "webui": 0.0}
+
+        # 资源列表缓存与启动预热，预热在后台进行，不阻塞插件加载
+        self.resource_cache = {}
+        self.warm_up_state = {"status": "未启用", "steps": []}
+        self.warm_up_task = None
+        if config.get("warm_up", {}).get("enable", True):
+            self.warm_up_task = asyncio.create_task(self._warm_up())
 
     @staticmethod
     def _select_prompt_option(group: dict, index_key: str, prefix: str, count: int = 4) -> str:
@@ -36,6 +647,128 @@ class SDGenerator(Star):
         """Join non-empty prompt segments with commas."""
         return ",".join(segment for segment in segments if segment)
 
+    @staticmethod
+    def _split_prompt_tags(prompt: str) -> list:
+        """按逗号拆分提示词，括号内的逗号不拆分"""
+        tags = []
+        depth = 0
+        current = []
+        for char in prompt:
+            if char in "([{<":
+                depth += 1
+            elif char in ")]}>":
+                depth = max(depth - 1, 0)
+            if char == "," and depth == 0:
+                tags.append("".join(current))
+                current = []
+            else:
+                current.append(char)
+        tags.append("".join(current))
+        return [" ".join(tag.split()) for tag in tags if tag.strip()]
+
+    @staticmethod
+    def _count_prompt_tokens(tag: str) -> int:
+        """统计单个提示词标签在 CLIP 中的 token 数，不含权重括号与 LoRA 等额外网络语法"""
+        text = PROMPT_SYNTAX_PATTERN.sub(" ", tag)
+        tokenizer = ClipTokenizer.get()
+        if tokenizer is None:
+            return len(CLIP_TOKEN_PATTERN.findall(text.lower()))
+        return tokenizer.count_tokens(text)
+
+    @classmethod
+    def _tag_token_entries(cls, tag: str) -> list:
+        """标签各部分的 token 数，BREAK/AND 关键字处为 None，表示强制分块边界"""
+        entries = []
+        for i, part in enumerate(PROMPT_CONTROL_PATTERN.split(tag)):
+            if i % 2:
+                entries.append(None)
+            elif part.strip():
+                entries.append(cls._count_prompt_tokens(part))
+        # 每个标签后的逗号本身也占一个 token
+        for i in range(len(entries) - 1, -1, -1):
+            if entries[i] is not None:
+                entries[i] += 1
+                break
+        return entries
+
+    @staticmethod
+    def _count_prompt_chunks(tag_tokens: list) -> int:
+        """按 WebUI 的方式估算分块数：标签尽量不跨块，每块 75 个 token，None 处强制结束当前分块"""
+        chunks, used = 0, 0
+        for tokens in tag_tokens:
+            if tokens is None:
+                # 与 WebUI 一致：BREAK 总会结束当前分块，即使该分块为空
+                chunks += 1
+                used = 0
+                continue
+            if used and used + tokens > CLIP_CHUNK_TOKENS:
+                chunks += 1
+                used = 0
+            used += tokens
+            while used > CLIP_CHUNK_TOKENS:
+                chunks += 1
+                used -= CLIP_CHUNK_TOKENS
+        return chunks + (1 if used or not chunks else 0)
+
+    def _analyze_prompt(self, prompt: str) -> (int, int):
+        """返回提示词的 token 数和分块数"""
+        entries = [entry for tag in self._split_prompt_tags(prompt) for entry in self._tag_token_entries(tag)]
+        return sum(entry for entry in entries if entry is not None), self._count_prompt_chunks(entries)
+
+    def _optimize_prompt(self, segments: list) -> str:
+        """合并提示词片段，跨片段去除重复标签，并可选地裁剪到最近的分块边界
+
+        Args:
+            segments: (提示词, 是否受保护) 列表，裁剪只会移除未受保护片段末尾的标签
+        """
+        optimizer = self.config.get("prompt_optimizer", {})
+        if not optimizer.get("enable", True):
+            return self._compose_prompt(*(text for text, _ in segments))
+
+        def flatten(items: list) -> list:
+            return [entry for _, _, entries in items for entry in entries]
+
+        tags = []
+        seen = set()
+        for text, protected in segments:
+            for tag in self._split_prompt_tags(text or ""):
+                entries = self._tag_token_entries(tag)
+                if None in entries:
+                    # 含 BREAK/AND 的标签决定分块与子提示词结构，从不去重；AND 之后是独立的子提示词，重新统计重复
+                    if "AND" in PROMPT_CONTROL_PATTERN.findall(tag):
+                        seen = set()
+                    tags.append([tag, True, entries])
+                    continue
+                key = tag.lower().replace("_", " ")
+                if key in seen:
+                    self.metrics["prompt_duplicate_tags"] += 1
+                    continue
+                seen.add(key)
+                tags.append([tag, protected, entries])
+
+        if optimizer.get("trim_to_chunk", False):
+            trim_max_tokens = optimizer.get("trim_max_tokens", 15)
+            # 只在最后一个 BREAK/AND 之后的尾段内裁剪，不改变显式指定的分块；尾段只占一块时无需裁剪
+            first_trimmable = max((i + 1 for i, (_, _, entries) in enumerate(tags) if None in entries), default=0)
+            chunks = self._count_prompt_chunks(flatten(tags[first_trimmable:]))
+            trimmed = list(tags)
+            removed_tokens = 0
+            while chunks > 1:
+                index = next(
+                    (i for i in range(len(trimmed) - 1, first_trimmable - 1, -1) if not trimmed[i][1]), None
+                )
+                if index is None:
+                    break
+                removed_tokens += sum(trimmed.pop(index)[2])
+                if removed_tokens > trim_max_tokens:
+                    break
+                if self._count_prompt_chunks(flatten(trimmed[first_trimmable:])) < chunks:
+                    self.metrics["prompt_trimmed_tags"] += len(tags) - len(trimmed)
+                    tags = trimmed
+                    break
+
+        return ",".join(tag for tag, _, _ in tags)
+
     def _validate_config(self):
         """配置验证"""
         self.config["webui_url"] = self.config["webui_url"].strip()
@@ -46,6 +779,21 @@ class SDGenerator(Star):
             self.config["webui_url"] = self.config["webui_url"].rstrip("/")
             self.config.save_config()
 
+    def _create_job_queue(self) -> JobQueue:
+        """按配置创建准入队列，sqlite 后端可让同一主机上的多个 AstrBot 实例共享并发上限"""
+        job_queue = self.config.get("job_queue", {})
+        priorities = {
+            lane: job_queue[f"{lane}_priority"] for lane in JOB_LANES if f"{lane}_priority" in job_queue
+        }
+        aging_seconds = job_queue.get("aging_seconds", DEFAULT_AGING_SECONDS)
+        if job_queue.get("backend", "memory") == "sqlite":
+            path = job_queue.get("sqlite_path", "").strip() or JOB_QUEUE_PATH
+            try:
+                return SQLiteJobQueue(path, self.max_concurrent_tasks, priorities, aging_seconds)
+            except sqlite3.Error as e:
+                logger.error(f"初始化共享任务队列 {path} 失败，改用进程内队列: {e}")
+        return InProcessJobQueue(self.max_concurrent_tasks, priorities, aging_seconds)
+
     async def ensure_session(self):
         """确保会话连接"""
         if self.session is None or self.session.closed:
@@ -53,22 +801,18 @@ class SDGenerator(Star):
                 timeout=aiohttp.ClientTimeout(self.config.get("session_timeout_time", 120))
             )
 
-    async def _fetch_webui_resource(self, resource_type: str) -> list:
-        """从 WebUI API 获取指定类型的资源列表"""
-        endpoint_map = {
-            "model": "/sdapi/v1/sd-models",
-            "embedding": "/sdapi/v1/embeddings",
-            "lora": "/sdapi/v1/loras",
-            "sampler": "/sdapi/v1/samplers",
-            "upscaler": "/sdapi/v1/upscalers"
-        }
-        if resource_type not in endpoint_map:
+    async def _fetch_webui_resource(self, resource_type: str, use_cache: bool = False) -> list:
+        """从 WebUI API 获取指定类型的资源列表，use_cache 为真时优先使用预取或上次获取的结果"""
+        if use_cache and self.resource_cache.get(resource_type):
+            return self.resource_cache[resource_type]
+
+        if resource_type not in RESOURCE_TYPES:
             logger.error(f"无效的资源类型: {resource_type}")
             return []
 
         try:
             await self.ensure_session()
-            async with self.session.get(f"{self.config['webui_url']}{endpoint_map[resource_type]}") as resp:
+            async with self.session.get(f"{self.config['webui_url']}{RESOURCE_TYPES[resource_type]}") as resp:
                 if resp.status == 200:
                     resources = await resp.json()
 
@@ -88,28 +832,87 @@ class SDGenerator(Star):
                         resource_names = []
 
                     logger.debug(f"从 WebUI 获取到的{resource_type}资源: {resource_names}")
+                    self.resource_cache[resource_type] = resource_names
                     return resource_names
         except Exception as e:
             logger.error(f"获取 {resource_type} 类型资源失败: {e}")
 
         return []
 
-    async def _get_sd_model_list(self):
-        return await self._fetch_webui_resource("model")
+    async def _get_sd_model_list(self, use_cache: bool = False):
+        return await self._fetch_webui_resource("model", use_cache)
 
-    async def _get_embedding_list(self):
-        return await self._fetch_webui_resource("embedding")
+    async def _get_embedding_list(self, use_cache: bool = False):
+        return await self._fetch_webui_resource("embedding", use_cache)
 
-    async def _get_lora_list(self):
-        return await self._fetch_webui_resource("lora")
+    async def _get_lora_list(self, use_cache: bool = False):
+        return await self._fetch_webui_resource("lora", use_cache)
 
-    async def _get_sampler_list(self):
+    async def _get_sampler_list(self, use_cache: bool = False):
         """获取可用的采样器列表"""
-        return await self._fetch_webui_resource("sampler")
+        return await self._fetch_webui_resource("sampler", use_cache)
 
-    async def _get_upscaler_list(self):
+    async def _get_upscaler_list(self, use_cache: bool = False):
         """获取可用的上采样算法列表"""
-        return await self._fetch_webui_resource("upscaler")
+        return await self._fetch_webui_resource("upscaler", use_cache)
+
+    async def _get_loaded_model(self) -> str:
+        """获取 WebUI 当前已加载的模型"""
+        await self.ensure_session()
+        async with self.session.get(f"{self.config['webui_url']}/sdapi/v1/options") as resp:
+            if resp.status != 200:
+                raise ConnectionError(f"获取 WebUI 设置失败 (状态码: {resp.status})")
+            options = await resp.json()
+            return options.get("sd_model_checkpoint", "")
+
+    async def _warm_up(self):
+        """启动预热：建立连接、预取资源列表、检查基础模型是否已加载，可选切换模型与执行一次极小的文生图"""
+        warm_up = self.config.get("warm_up", {})
+        started_at = time.monotonic()
+        self.warm_up_state = {"status": "进行中", "steps": [], "warnings": []}
+        steps = self.warm_up_state["steps"]
+        try:
+            if await asyncio.to_thread(ClipTokenizer.get):
+                steps.append("CLIP词表")
+            else:
+                self.warm_up_state["warnings"].append("CLIP 词表加载失败，token 统计为近似值")
+
+            if not (await self._check_webui_available())[0]:
+                raise ConnectionError("WebUI 无连接")
+            steps.append("连接")
+
+            await asyncio.gather(*(self._fetch_webui_resource(t) for t in RESOURCE_TYPES))
+            steps.append("资源列表")
+            base_model = self.config.get("base_model", "").strip()
+            if base_model:
+                loaded_model = await self._get_loaded_model()
+                if base_model in loaded_model:
+                    steps.append("基础模型")
+                elif warm_up.get("load_base_model", False):
+                    # 切换模型会影响共用该 WebUI 的其他客户端，仅在显式开启时执行
+                    logger.info(f"WebUI 当前模型为 {loaded_model}，预热时切换为 {base_model}")
+                    if not await self._set_model(base_model):
+                        raise ConnectionError(f"加载基础模型 {base_model} 失败")
+                    steps.append("基础模型")
+                else:
+                    logger.warning(f"WebUI 当前模型为 {loaded_model}，与配置的基础模型 {base_model} 不一致")
+                    self.warm_up_state["warnings"].append(f"当前模型 {loaded_model} 与基础模型 {base_model} 不一致")
+
+            if warm_up.get("dummy_generation", False):
+                async with self._generation_slot("warm_up"):
+                    # 与普通任务一样经过后端准入，不会插到其他客户端或本插件已发出的请求之间
+                    async with self._backend_admission("warm_up"):
+                        await self._call_sd_api(
+                            "/sdapi/v1/txt2img", {"prompt": "warm up", "width": 64, "height": 64, "steps": 1}
+                        )
+                steps.append("预热生成")
+
+            self.warm_up_state["status"] = "完成"
+        except Exception as e:
+            logger.warning(f"SDGen 预热失败: {e}")
+            self.warm_up_state["status"] = f"失败（{e}）"
+        finally:
+            self.warm_up_state["duration"] = time.monotonic() - started_at
 
     def _build_negative_prompt(self) -> str:
         """Assemble negative prompt from global and user presets."""
@@ -124,14 +927,146 @@ class SDGenerator(Star):
         user_negative_prompt = self._select_prompt_option(
             user_negative_group, "user_negative_prompt_list", "user_negative_prompt"
         )
-        return self._compose_prompt(global_negative_prompt, user_negative_prompt)
+        return self._optimize_prompt([(global_negative_prompt, True), (user_negative_prompt, True)])
 
-    async def _generate_payload(self, prompt: str) -> dict:
-        """构建生成参数"""
+    @staticmethod
+    def _parse_inline_overrides(text: str) -> (str, dict):
+        """从提示词中拆出 --size 768x512 等单次生成参数，返回剩余提示词和覆盖参数"""
+        tokens = (text or "").split()
+        remaining = []
+        overrides = {}
+
+        i = 0
+        while i < len(tokens):
+            option = tokens[i].lower()
+            if option in FLAG_OVERRIDE_OPTIONS:
+                key, value = FLAG_OVERRIDE_OPTIONS[option]
+                overrides[key] = value
+            elif option in VALUE_OVERRIDE_OPTIONS:
+                if i + 1 >= len(tokens):
+                    raise ValueError(f"参数 {tokens[i]} 缺少取值")
+                i += 1
+                overrides[VALUE_OVERRIDE_OPTIONS[option]] = tokens[i]
+            else:
+                remaining.append(tokens[i])
+            i += 1
+
+        return " ".join(remaining), overrides
+
+    @staticmethod
+    def _normalize_overrides(overrides: dict, check_ranges: bool = True) -> dict:
+        """校验并转换单次生成参数，非法取值抛出 ValueError
+
+        check_ranges 为假时不检查步数范围，用于按原样重放历史记录（草稿的步数可能低于下限）。
+        """
+        def to_int(key: str, value) -> int:
+            try:
+                return int(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"参数 {key} 需为整数")
+
+        normalized = {}
+        for key, value in (overrides or {}).items():
+            if value is None:
+                continue
+            if key == "size":
+                match = re.fullmatch(r"(\d+)[xX*](\d+)", str(value))
+                if not match:
+                    raise ValueError("尺寸格式应为 宽x高，例如 768x512")
+                width, height = int(match.group(1)), int(match.group(2))
+                if not (1 <= width <= 2048 and 1 <= height <= 2048):
+                    raise ValueError("分辨率仅支持:1-2048之间的任意整数")
+                normalized["width"], normalized["height"] = width, height
+            elif key in ("width", "height"):
+                size = to_int(key, value)
+                if not 1 <= size <= 2048:
+                    raise ValueError("分辨率仅支持:1-2048之间的任意整数")
+                normalized[key] = size
+            elif key == "steps":
+                steps = to_int(key, value)
+                if check_ranges and not 10 <= steps <= 50:
+                    raise ValueError("步数需设置在 10 到 50 之间")
+                normalized["steps"] = steps
+            elif key == "batch_size":
+                batch_size = to_int(key, value)
+                if not 1 <= batch_size <= 10:
+                    raise ValueError("图片生成的批数量需设置在 1 到 10 之间")
+                normalized["batch_size"] = batch_size
+            elif key == "n_iter":
+                n_iter = to_int(key, value)
+                if n_iter < 1:
+                    raise ValueError("生成批次数需为正整数")
+                normalized["n_iter"] = n_iter
+            elif key == "cfg_scale":
+                try:
+                    # 保留数值原本的类型，使重放的参数与历史记录一致（结果缓存按参数比对）
+                    cfg_scale = value if isinstance(value, (int, float)) else float(value)
+                except (TypeError, ValueError):
+                    raise ValueError(f"参数 {key} 需为数字")
+                if cfg_scale <= 0:
+                    raise ValueError("提示词权重需大于 0")
+                normalized["cfg_scale"] = cfg_scale
+            elif key == "seed":
+                seed = to_int(key, value)
+                if seed < -1:
+                    raise ValueError("种子需为非负整数，-1 表示随机")
+                normalized["seed"] = seed
+            elif key == "sampler":
+                # 与自定义提示词一致，使用 ~ 代替采样器名称中的空格
+                normalized["sampler"] = str(value).replace("~", " ").strip()
+            elif key in ("upscale", "draft"):
+                normalized[key] = bool(value)
+        return normalized
+
+    def _resolve_generation_params(self, overrides: dict = None) -> dict:
+        """合并全局默认参数与单次覆盖参数，并应用草稿模式"""
         params = self.config["default_params"]
+        overrides = overrides or {}
+
+        resolved = {
+            "width": params["width"],
+            "height": params["height"],
+            "steps": params["steps"],
+            "sampler": params["sampler"],
+            "cfg_scale": params["cfg_scale"],
+            "batch_size": params["batch_size"],
+            "n_iter": params["n_iter"],
+            "seed": -1,
+            "enable_upscale": self.config.get("enable_upscale", False),
+            "draft": False,
+        }
+        for key in ("width", "height", "steps", "sampler", "cfg_scale", "batch_size", "n_iter", "seed", "draft"):
+            if key in overrides:
+                resolved[key] = overrides[key]
+        if "upscale" in overrides:
+            resolved["enable_upscale"] = overrides["upscale"]
+
+        if resolved["draft"]:
+            draft_params = self.config.get("draft_params", {})
+            scale = min(max(float(draft_params.get("scale", 0.5)), 0.1), 1.0)
+            # WebUI 要求宽高为 8 的倍数，草稿最小 64 像素
+            resolved["width"] = max(64, int(resolved["width"] * scale) // 8 * 8)
+            resolved["height"] = max(64, int(resolved["height"] * scale) // 8 * 8)
+            resolved["steps"] = min(resolved["steps"], draft_params.get("steps", 10))
+            resolved["enable_upscale"] = False
+            # 草稿需要固定种子，才能以相同种子提升为完整质量
+            if resolved["seed"] == -1:
+                resolved["seed"] = random.randint(0, 2 ** 32 - 1)
+
+        return resolved
+
+    async def _generate_payload(
+        self,
+        prompt: str,
+        params: dict = None,
+        init_image: str = None,
+        denoising_strength: float = None
+    ) -> dict:
+        """构建生成参数，提供 init_image 时构建图生图参数"""
+        params = params or self._resolve_generation_params()
         negative_prompt = self._build_negative_prompt()
 
-        return {
+        payload = {
             "prompt": prompt,
             "negative_prompt": negative_prompt,
             "width": params["width"],
@@ -141,14 +1076,146 @@ class SDGenerator(Star):
             "cfg_scale": params["cfg_scale"],
             "batch_size": params["batch_size"],
             "n_iter": params["n_iter"],
+            "seed": params["seed"],
         }
+        if init_image:
+            payload["init_images"] = [init_image]
+            payload["denoising_strength"] = denoising_strength
+            # 裁剪后缩放：底图比例与目标尺寸不同时居中裁剪，而不是拉伸变形
+            payload["resize_mode"] = 1
+        return payload
+
+    def _queue_depth(self) -> int:
+        """尚未发往 WebUI 的任务数：等待并发槽位的任务，加上已占用槽位但仍在后端准入处等待的任务"""
+        return self.queued_tasks + self.backend_waiting
+
+    def _get_degradation_level(self) -> int:
+        """根据排队深度与近期耗时计算降级级别，负载下降后自动恢复"""
+        degradation = self.config.get("degradation", {})
+        if not degradation.get("enable", False):
+            return 0
+
+        queue_depth_step = max(1, degradation.get("queue_depth_step", 3))
+        queue_depth = self._queue_depth()
+        level = queue_depth // queue_depth_step
+        # 平均耗时只在完成任务时更新，空闲时不会回落；仅当仍有任务在排队或生成时才计入，避免空闲后首个请求被降级
+        busy = queue_depth > 0 or self.active_tasks > 0
+        if busy and self.latency_ewma > degradation.get("latency_threshold_seconds", 60):
+            level += 1
+        return min(level, len(DEGRADATION_STAGES))
+
+    def _apply_degradation(self, params: dict) -> (dict, list):
+        """按当前降级级别逐级调整生成参数，返回新参数和实际生效的降级措施"""
+        level = self._get_degradation_level()
+        if level == 0:
+            return params, []
+
+        degradation = self.config.get("degradation", {})
+        degraded = dict(params)
+        notes = []
+        if level >= 1 and degraded["enable_upscale"]:
+            degraded["enable_upscale"] = False
+            notes.append(DEGRADATION_STAGES[0])
+        max_steps = degradation.get("max_steps", 20)
+        if level >= 2 and degraded["steps"] > max_steps:
+            degraded["steps"] = max_steps
+            notes.append(f"{DEGRADATION_STAGES[1]}为 {max_steps}")
+        max_side = degradation.get("max_side", 512)
+        longest_side = max(degraded["width"], degraded["height"])
+        if level >= 3 and longest_side > max_side:
+            scale = max_side / longest_side
+            degraded["width"] = max(64, int(degraded["width"] * scale) // 8 * 8)
+            degraded["height"] = max(64, int(degraded["height"] * scale) // 8 * 8)
+            notes.append(f"{DEGRADATION_STAGES[2]}为 {degraded['width']}x{degraded['height']}")
+        max_batch_size = degradation.get("max_batch_size", 1)
+        if level >= 4 and degraded["batch_size"] > max_batch_size:
+            degraded["batch_size"] = max_batch_size
+            degraded["n_iter"] = 1
+            notes.append(f"{DEGRADATION_STAGES[3]}为 {max_batch_size}")
+
+        if notes:
+            self.metrics["degraded_jobs"] += 1
+            self.metrics[f"degraded_level_{level}"] += 1
+        return degraded, notes
+
+    def _record_latency(self, seconds: float):
+        """更新任务耗时的滑动平均"""
+        if self.latency_ewma == 0:
+            self.latency_ewma = seconds
+        else:
+            self.latency_ewma += LATENCY_EWMA_ALPHA * (seconds - self.latency_ewma)
+
+    async def _monitor_loop_lag(self):
+        """按固定间隔休眠，实际唤醒时间与预期之差即为事件循环的调度延迟"""
+        loop_monitor = self.config.get("loop_monitor", {})
+        interval = loop_monitor.get("interval_seconds", 0.5)
+        warn_threshold = loop_monitor.get("warn_threshold_ms", 200) / 1000
+        while True:
+            started_at = time.monotonic()
+            await asyncio.sleep(interval)
+            lag = max(0.0, time.monotonic() - started_at - interval)
+            self.loop_lag["last"] = lag
+            self.loop_lag["ewma"] += LATENCY_EWMA_ALPHA * (lag - self.loop_lag["ewma"])
+            self.loop_lag["max"] = max(self.loop_lag["max"], lag)
+            if lag > warn_threshold:
+                self.metrics["loop_lag_warnings"] += 1
+                logger.warning(f"事件循环调度延迟 {lag * 1000:.0f} ms")
+
+    def _estimate_cost(self, params: dict) -> float:
+        """估算一次生成的 GPU 成本（像素 × 步数 × 图片数，外加放大）"""
+        images = params["batch_size"] * params["n_iter"]
+        pixels = params["width"] * params["height"]
+        cost = pixels / BASE_COST_PIXELS * params["steps"] / BASE_COST_STEPS * images
+
+        if params["enable_upscale"]:
+            upscale_factor = self.config["default_params"].get("upscale_factor") or 2
+            cost += pixels * upscale_factor ** 2 / BASE_COST_PIXELS * UPSCALE_COST_WEIGHT * images
+        return cost
+
+    def _get_quota_buckets(self, event: AstrMessageEvent) -> list:
+        """获取事件对应的用户与群组令牌桶，未启用配额时返回空列表"""
+        quota = self.config.get("quota", {})
+        if not quota.get("enable", False):
+            return []
+
+        if len(self.quota_buckets) > MAX_QUOTA_BUCKETS:
+            # 已回满的令牌桶与新建无异，可以丢弃
+            for key in [key for key, bucket in self.quota_buckets.items() if bucket.wait_time(bucket.capacity) == 0]:
+                del self.quota_buckets[key]
+
+        platform = event.get_platform_name()
+        targets = [(f"user:{platform}:{event.get_sender_id()}", "user")]
+        group_id = event.get_group_id()
+        if group_id:
+            targets.append((f"group:{platform}:{group_id}", "group"))
+
+        buckets = []
+        for key, scope in targets:
+            bucket = self.quota_buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(
+                    float(quota.get(f"{scope}_capacity", 20)),
+                    float(quota.get(f"{scope}_refill_per_minute", 5)) / 60
+                )
+                self.quota_buckets[key] = bucket
+            buckets.append(bucket)
+        return buckets
+
+    @staticmethod
+    def _reserve_quota(buckets: list, cost: float) -> float:
+        """所有令牌桶均足够时扣除成本并返回 0，否则返回需等待的秒数"""
+        wait = max((bucket.wait_time(cost) for bucket in buckets), default=0.0)
+        if wait == 0:
+            for bucket in buckets:
+                bucket.consume(cost)
+        return wait
 
     def _trans_prompt(self, prompt: str) -> str:
         """返回原始提示词（保留空格）"""
         return prompt
 
     @staticmethod
-    def _extract_prompt_from_message(event: AstrMessageEvent, raw_prompt: str) -> str:
+    def _extract_prompt_from_message(event: AstrMessageEvent, raw_prompt: str, subcommand: str = "gen") -> str:
         """从原始消息还原提示词，避免参数解析截断空格"""
         full = (event.message_str or "").strip()
         base = (raw_prompt or "").strip()
@@ -159,7 +1226,7 @@ class SDGenerator(Star):
         tokens = full.split()
         if tokens and tokens[0].lstrip("/") in ("sd",):
             tokens = tokens[1:]
-        if tokens and tokens[0] == "gen":
+        if tokens and tokens[0] == subcommand:
             tokens = tokens[1:]
 
         fallback = " ".join(tokens).strip()
@@ -184,9 +1251,10 @@ class SDGenerator(Star):
             generated_prompt if self.config.get("enable_generate_prompt") and generated_prompt else self._trans_prompt(raw_prompt)
         )
 
+        # 全局与用户预设提示词受保护，裁剪时只会移除用户输入或 LLM 生成部分末尾的标签
         if add_global_first:
-            return self._compose_prompt(global_positive_prompt, user_positive_prompt, base_prompt)
-        return self._compose_prompt(base_prompt, global_positive_prompt, user_positive_prompt)
+            return self._optimize_prompt([(global_positive_prompt, True), (user_positive_prompt, True), (base_prompt, False)])
+        return self._optimize_prompt([(base_prompt, False), (global_positive_prompt, True), (user_positive_prompt, True)])
 
     async def _generate_prompt(self, prompt: str) -> str:
         provider = self.context.get_using_provider()
@@ -224,19 +1292,401 @@ class SDGenerator(Star):
         except aiohttp.ClientError as e:
             raise ConnectionError(f"连接失败: {str(e)}")
 
-    async def _call_t2i_api(self, prompt: str) -> dict:
+    async def _probe_backend(self) -> (bool, float):
+        """查询 WebUI 是否正在执行任务，返回 (是否忙碌, 预计剩余秒数)，查询失败时视为空闲"""
+        self.metrics["backend_polls"] += 1
+        try:
+            await self.ensure_session()
+            async with self.session.get(
+                f"{self.config['webui_url']}/sdapi/v1/progress", params={"skip_current_image": "true"}
+            ) as resp:
+                if resp.status != 200:
+                    raise ConnectionError(f"查询进度失败 (状态码: {resp.status})")
+                progress = await resp.json()
+        except (ConnectionError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.debug(f"查询 WebUI 进度失败，直接发送任务: {e}")
+            return False, 0.0
+
+        state = progress.get("state") or {}
+        busy = (state.get("job_count") or 0) > 0 or bool(state.get("job"))
+        return busy, float(progress.get("eta_relative") or 0)
+
+    @asynccontextmanager
+    async def _backend_admission(self, lane: str = "command"):
+        """在生成请求发往 WebUI 前等待后端空闲，避免任务堆积在 WebUI 内部无法取消和调整的队列中
+
+        同一时间只有一个任务（按优先级通道排序）在轮询后端状态。轮询间隔自适应：
+        WebUI 给出预计剩余时间时按其一半等待，否则从最小间隔开始指数退避；本插件的请求返回时立即重试。
+        """
+        admission = self.config.get("backend_admission", {})
+        if not admission.get("enable", True):
+            yield
+            return
+
+        capacity = admission.get("capacity", 1)
+        min_interval = admission.get("min_poll_interval", 0.25)
+        max_interval = max(min_interval, admission.get("max_poll_interval", 2.0))
+        max_wait = admission.get("max_wait_seconds", 300)
+
+        job_id = uuid.uuid4().hex
+        started = time.monotonic()
+        self.backend_waiting += 1
+        try:
+            await self.dispatch_queue.acquire(job_id, lane)
+        except BaseException:
+            self.backend_waiting -= 1
+            raise
+        try:
+            interval = min_interval
+            while True:
+                eta = 0.0
+                if self.backend_inflight < capacity:
+                    # 已有本插件的请求在途时，WebUI 报告的任务即为该请求，无需再查询
+                    if self.backend_inflight > 0:
+                        break
+                    busy, eta = await self._probe_backend()
+                    if not busy:
+                        break
+                if time.monotonic() - started > max_wait:
+                    logger.warning(f"等待 WebUI 空闲超过 {max_wait} 秒，直接发送任务")
+                    self.metrics["backend_admission_timeouts"] += 1
+                    break
+
+                wait = min(max(eta / 2, min_interval), max_interval) if eta > 0 else interval
+                interval = min(interval * 2, max_interval)
+                self.backend_idle.clear()
+                try:
+                    await asyncio.wait_for(self.backend_idle.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+            self.backend_inflight += 1
+        finally:
+            self.backend_waiting -= 1
+            await self.dispatch_queue.release(job_id)
+
+        waited = time.monotonic() - started
+        self.metrics["backend_dispatched"] += 1
+        if self.metrics["backend_dispatched"] == 1:
+            self.backend_wait_ewma = waited
+        else:
+            self.backend_wait_ewma += LATENCY_EWMA_ALPHA * (waited - self.backend_wait_ewma)
+        try:
+            yield
+        finally:
+            self.backend_inflight -= 1
+            self.backend_idle.set()
+
+    async def _call_t2i_api(self, payload: dict) -> dict:
         """调用 Stable Diffusion 文生图 API"""
-        await self.ensure_session()
-        payload = await self._generate_payload(prompt)
         return await self._call_sd_api("/sdapi/v1/txt2img", payload)
 
-    async def _apply_image_processing(self, image_origin: str) -> str:
-        """统一处理高分辨率修复与超分辨率放大"""
+    async def _call_i2i_api(self, payload: dict) -> dict:
+        """调用 Stable Diffusion 图生图 API"""
+        return await self._call_sd_api("/sdapi/v1/img2img", payload)
+
+    def _get_history(self, event: AstrMessageEvent) -> deque:
+        """获取会话的生成历史，最近使用的会话排在最后"""
+        session = event.unified_msg_origin
+        history = self.history.get(session)
+        if history is None:
+            history = self.history[session] = deque()
+            while len(self.history) > MAX_HISTORY_SESSIONS:
+                _, evicted = self.history.popitem(last=False)
+                for record in evicted:
+                    self._discard_record(record)
+        self.history.move_to_end(session)
+        return history
+
+    @staticmethod
+    def _parse_history_index(value) -> int:
+        """解析指令参数中的历史序号，AstrBot 对非纯数字的参数会原样传入字符串"""
+        try:
+            index = int(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"序号需为正整数，收到：{value}")
+        if index < 1:
+            raise ValueError(f"序号需为正整数，收到：{value}")
+        return index
+
+    @staticmethod
+    def _parse_strength(value) -> float:
+        """解析重绘幅度，需在 0 到 1 之间"""
+        try:
+            strength = float(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"重绘幅度需为 0 到 1 之间的数字，收到：{value}")
+        if not 0 < strength <= 1:
+            raise ValueError("重绘幅度需在 0 到 1 之间")
+        return strength
+
+    def _get_history_record(self, event: AstrMessageEvent, index: int):
+        """按序号获取历史记录，1 为最近一张"""
+        history = self.history.get(event.unified_msg_origin)
+        if not history or index < 1 or index > len(history):
+            return None
+        return history[-index]
+
+    async def _add_history(self, event: AstrMessageEvent, prompt: str, payload: dict, response: dict):
+        """将本次生成的原始图片（放大前）写入临时目录并记入会话历史，返回批次的生成信息"""
+        info = GenerationInfo(response.get("info"))
+        history_size = self.config.get("history", {}).get("size", 10)
+        if history_size <= 0:
+            return info
+
+        record_payload = {key: value for key, value in payload.items() if key != "init_images"}
+        key = self._result_key(record_payload)
+
+        history = self._get_history(event)
+        for i, image in enumerate(response["images"]):
+            image_path = os.path.join(HISTORY_PATH, f"sdgen_{uuid.uuid4().hex}.png")
+            await asyncio.to_thread(self._write_image, image_path, image)
+            record = GenerationRecord(prompt, record_payload, info, i, image_path)
+            history.append(record)
+            if key:
+                self.result_index.setdefault(key, []).append(record)
+            while len(history) > history_size:
+                self._discard_record(history.popleft())
+        return info
+
+    @staticmethod
+    def _result_key(payload: dict):
+        """除种子与批次外的文生图参数，作为结果缓存的索引；图生图结果依赖底图，不参与缓存"""
+        if "denoising_strength" in payload or "init_images" in payload:
+            return None
+        params = {key: value for key, value in payload.items() if key not in ("seed", "batch_size", "n_iter")}
+        return json.dumps(params, sort_keys=True, ensure_ascii=False)
+
+    def _discard_record(self, record: GenerationRecord):
+        """移出历史记录：删除缓存图片并从结果索引中移除"""
+        record.remove_image()
+        key = self._result_key(record.payload)
+        records = self.result_index.get(key)
+        if records and record in records:
+            records.remove(record)
+            if not records:
+                del self.result_index[key]
+
+    async def _find_cached_result(self, payload: dict):
+        """查找种子固定、参数相同的历史图片，全部命中且模型未变时返回与 WebUI 格式相同的结果"""
+        if payload["seed"] == -1 or not self.config.get("history", {}).get("cache_results", True):
+            return None
+        records = self.result_index.get(self._result_key(payload))
+        if not records:
+            return None
+
+        # 与 WebUI 一致：批次中第 i 张图片的种子为请求种子 + i
+        count = payload["batch_size"] * payload["n_iter"]
+        by_seed = {record.seed: record for record in records}
+        matched = [by_seed.get(payload["seed"] + i) for i in range(count)]
+        if not all(matched):
+            return None
+
+        # 模型切换后相同种子的结果不同，需确认当前模型与缓存时一致
+        model_hash = matched[0].details.model_hash
+        try:
+            if not model_hash or model_hash not in await self._get_loaded_model():
+                return None
+        except (ConnectionError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"获取当前模型失败，跳过结果缓存: {e!r}")
+            return None
+
+        try:
+            images = [await self._load_history_image(record) for record in matched]
+        except OSError:
+            return None
+        infos = [record.details for record in matched]
+        return {"images": images, "infos": infos}
+
+    @staticmethod
+    def _write_image(path: str, image: str):
+        """解码 base64 图片并写入文件，在线程中执行"""
+        with open(path, "wb") as f:
+            f.write(base64.b64decode(image))
+
+    @staticmethod
+    def _clear_history_files():
+        """清空历史图片目录，并移除旧版本直接写在临时目录中的历史图片
+
+        历史记录只保存在内存中，进程崩溃或被强制结束后遗留的图片不会再被引用。
+        """
+        os.makedirs(HISTORY_PATH, exist_ok=True)
+        for directory in (HISTORY_PATH, TEMP_PATH):
+            for entry in os.scandir(directory):
+                if entry.is_file() and entry.name.startswith("sdgen_") and entry.name.endswith(".png"):
+                    try:
+                        os.remove(entry.path)
+                    except OSError as e:
+                        logger.warning(f"清理遗留的历史图片 {entry.name} 失败: {e}")
+
+    @staticmethod
+    def _read_file(path: str) -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+
+    async def _load_history_image(self, record: GenerationRecord) -> str:
+        """读取历史记录缓存的图片，返回 base64"""
+        data = await asyncio.to_thread(self._read_file, record.image_path)
+        return base64.b64encode(data).decode("utf-8")
+
+    async def _read_image_component(self, component) -> bytes:
+        """读取消息中图片组件的原始数据"""
+        if hasattr(component, "convert_to_base64"):
+            return base64.b64decode(await component.convert_to_base64())
+
+        source = component.url or component.file or ""
+        if source.startswith("base64://"):
+            return base64.b64decode(source[len("base64://"):])
+        if source.startswith(("http://", "https://")):
+            await self.ensure_session()
+            async with self.session.get(source) as resp:
+                if resp.status != 200:
+                    raise ConnectionError(f"下载图片失败 (状态码: {resp.status})")
+                return await resp.read()
+        if source.startswith("file:///"):
+            source = source[len("file:///"):]
+        return await asyncio.to_thread(self._read_file, source)
+
+    async def _get_event_image(self, event: AstrMessageEvent):
+        """获取消息（或其引用的消息）中的第一张图片，没有图片时返回 None"""
+        for component in event.get_messages():
+            if isinstance(component, Image):
+                return await self._read_image_component(component)
+            if isinstance(component, Reply) and component.chain:
+                for quoted in component.chain:
+                    if isinstance(quoted, Image):
+                        return await self._read_image_component(quoted)
+        return None
+
+    def _get_process_pool(self) -> ProcessPoolExecutor:
+        """获取共用的工作进程池，进程数取图生图预处理与本地放大配置中的较大值"""
+        if self.process_pool is None:
+            workers = max(
+                self.config.get("img2img", {}).get("preprocess_workers", 1),
+                self.config.get("cpu_upscale", {}).get("workers", 1),
+            )
+            self.process_pool = ProcessPoolExecutor(max_workers=workers)
+        return self.process_pool
+
+    async def _prepare_init_image(self, data: bytes, width: int, height: int, keep_aspect: bool) -> (str, int, int):
+        """预处理图生图底图，相同内容与目标尺寸的图片直接复用上次的结果"""
+        digest = await asyncio.to_thread(lambda: hashlib.sha256(data).hexdigest())
+        key = (digest, width, height, keep_aspect)
+        if key in self.preprocess_cache:
+            self.preprocess_cache.move_to_end(key)
+            self.metrics["preprocess_cache_hits"] += 1
+            return self.preprocess_cache[key]
+
+        if PILImage is None:
+            logger.warning("未安装 Pillow，图生图底图将不经预处理直接上传")
+            prepared = (base64.b64encode(data).decode("utf-8"), width, height)
+        else:
+            encoded, width, height = await asyncio.get_running_loop().run_in_executor(
+                self._get_process_pool(), _preprocess_image, data, width, height, keep_aspect
+            )
+            prepared = (base64.b64encode(encoded).decode("utf-8"), width, height)
+
+        self.preprocess_cache[key] = prepared
+        while len(self.preprocess_cache) > MAX_PREPROCESS_CACHE:
+            self.preprocess_cache.popitem(last=False)
+        return prepared
+
+    async def _run_img2img(
+        self,
+        event: AstrMessageEvent,
+        prompt: str,
+        overrides: dict,
+        strength: float,
+        allow_generate_prompt: bool,
+        lane: str = None
+    ):
+        """从消息中取出图片，预处理后以图生图方式生成"""
+        try:
+            data = await self._get_event_image(event)
+        except Exception as e:
+            logger.error(f"读取消息图片失败: {e}")
+            yield event.plain_result("❌ 读取消息中的图片失败，请检查日志")
+            return
+        if data is None:
+            yield event.plain_result("⚠️ 请在消息中附带或引用一张图片")
+            return
+
+        if strength is None:
+            strength = self.config.get("img2img", {}).get("denoising_strength", 0.6)
+        try:
+            strength = self._parse_strength(strength)
+            overrides = self._normalize_overrides(overrides)
+        except ValueError as e:
+            yield event.plain_result(f"⚠️ {e}")
+            return
+
+        # 未指定尺寸时按原图比例，使用不超过默认分辨率像素数的尺寸
+        keep_aspect = "width" not in overrides and "height" not in overrides
+        params = self.config["default_params"]
+        width = overrides.get("width", params["width"])
+        height = overrides.get("height", params["height"])
+        try:
+            init_image, width, height = await self._prepare_init_image(data, width, height, keep_aspect)
+        except Exception as e:
+            logger.error(f"预处理图生图底图失败: {e}")
+            yield event.plain_result("❌ 无法识别消息中的图片，请换一张再试")
+            return
+
+        async for result in self._run_generate_image(
+            event,
+            prompt,
+            allow_generate_prompt=allow_generate_prompt,
+            allow_extract_prompt=False,
+            overrides={**overrides, "width": width, "height": height},
+            init_image=init_image,
+            denoising_strength=strength,
+            lane=lane
+        ):
+            yield result
+
+    @staticmethod
+    def _record_overrides(record: GenerationRecord) -> dict:
+        """从历史记录还原单次生成参数，沿用原图的种子，需作为 replay_overrides 传入以跳过范围检查"""
+        payload = record.payload
+        return {
+            "width": payload["width"],
+            "height": payload["height"],
+            "steps": payload["steps"],
+            "sampler": payload["sampler_name"],
+            "cfg_scale": payload["cfg_scale"],
+            "seed": record.seed,
+            "batch_size": 1,
+            "n_iter": 1,
+        }
+
+    async def _should_upscale_locally(self) -> bool:
+        """决定本次放大是否改用本地 CPU：插值类算法始终本地处理，其余算法仅在后端排队过多时退回本地"""
+        config = self.config.get("cpu_upscale", {})
+        mode = config.get("mode", "auto")
+        if PILImage is None or mode == "never":
+            return False
+        if mode == "always" or self.config["default_params"]["upscaler"] in LOCAL_UPSCALERS:
+            return True
+        queued = max(self._queue_depth(), (await self.job_queue.stats())["queued"] + self.backend_waiting)
+        return queued >= config.get("queue_threshold", 2)
+
+    async def _upscale_locally(self, image_origin: str) -> str:
+        """在工作进程池中插值放大图片，不占用 GPU"""
+        params = self.config["default_params"]
+        factor = float(params["upscale_factor"] or 2)
+        sharpen = self.config.get("cpu_upscale", {}).get("sharpen", True)
+        data = await asyncio.to_thread(base64.b64decode, image_origin)
+        output = await asyncio.get_running_loop().run_in_executor(
+            self._get_process_pool(), _upscale_image_local, data, factor, params["upscaler"], sharpen
+        )
+        return await asyncio.to_thread(lambda: base64.b64encode(output).decode("utf-8"))
+
+    async def _upscale_with_webui(self, image_origin: str, upscaler: str = None) -> str:
+        """调用 WebUI 附加功能接口放大图片"""
 
         # 获取配置参数
         params = self.config["default_params"]
         upscale_factor = params["upscale_factor"] or "2"
-        upscaler = params["upscaler"] or "未设置"
+        upscaler = upscaler or params["upscaler"] or "未设置"
 
         # 根据配置构建payload
         payload = {
@@ -257,6 +1707,25 @@ class SDGenerator(Star):
         resp = await self._call_sd_api("/sdapi/v1/extra-single-image", payload)
         return resp["image"]
 
+    async def _apply_image_processing(self, image_origin: str, local: bool = None) -> str:
+        """统一处理超分辨率放大，local 为 None 时根据配置与后端负载自动选择放大路径"""
+        if local is None:
+            local = await self._should_upscale_locally()
+        path = "local" if local else "webui"
+        started = time.monotonic()
+        if local:
+            image = await self._upscale_locally(image_origin)
+        else:
+            image = await self._upscale_with_webui(image_origin)
+
+        elapsed = time.monotonic() - started
+        self.metrics[f"upscale_{path}"] += 1
+        if self.upscale_latency[path] == 0:
+            self.upscale_latency[path] = elapsed
+        else:
+            self.upscale_latency[path] += LATENCY_EWMA_ALPHA * (elapsed - self.upscale_latency[path])
+        return image
+
     async def _set_model(self, model_name: str) -> bool:
         """设置图像生成模型，并存入 config"""
         try:
@@ -334,6 +1803,60 @@ class SDGenerator(Star):
             f"- 上采样算法: {upscaler}"
         )
 
+    def _get_warm_up_status(self) -> str:
+        """获取启动预热状态"""
+        state = self.warm_up_state
+        message = f"🔥 预热状态: {state['status']}"
+        if state["steps"]:
+            message += f"，已完成: {'、'.join(state['steps'])}"
+        if "duration" in state:
+            message += f"，耗时 {state['duration']:.1f} 秒"
+        for warning in state.get("warnings", ()):
+            message += f"\n⚠️ {warning}"
+        return message
+
+    async def _get_load_status(self) -> str:
+        """获取当前负载、降级状态与运行统计"""
+        level = self._get_degradation_level()
+        stages = "、".join(DEGRADATION_STAGES[:level]) or "无"
+        queue_stats = await self.job_queue.stats()
+        lines = [
+            f"- 运行中/排队任务: {self.active_tasks - self.backend_waiting}/{self._queue_depth()}"
+            f"（其中 {self.backend_waiting} 个已占用槽位、等待 WebUI 空闲）",
+            f"- 准入队列（{type(self.job_queue).__name__}）运行中/排队: {queue_stats['active']}/{queue_stats['queued']}",
+            f"- 平均耗时: {self.latency_ewma:.1f} 秒",
+            f"- 事件循环延迟: 最近 {self.loop_lag['last'] * 1000:.1f} ms，"
+            f"平均 {self.loop_lag['ewma'] * 1000:.1f} ms，最大 {self.loop_lag['max'] * 1000:.1f} ms",
+            f"- 降级级别: {level}（{stages}）",
+            *(
+                f"- {JOB_LANES[lane][0]}通道: 排队 {stats['queued']}，已调度 {stats['jobs']}，"
+                f"平均等待 {stats['wait_ewma']:.1f} 秒，最长等待 {stats['wait_max']:.1f} 秒"
+                for lane, stats in self.lane_stats.items() if stats["jobs"] or stats["queued"]
+            ),
+            f"- 后端准入: 在途 {self.backend_inflight}，已发送 {self.metrics['backend_dispatched']}，"
+            f"平均等待 {self.backend_wait_ewma:.1f} 秒",
+            f"- 放大平均耗时: 本地 {self.upscale_latency['local']:.2f} 秒，WebUI {self.upscale_latency['webui']:.2f} 秒",
+        ]
+        if self.metrics:
+            lines.append("- 统计: " + ", ".join(f"{key}={value}" for key, value in sorted(self.metrics.items())))
+        return "📊 负载状态:\n" + "\n".join(lines)
+
+    async def terminate(self):
+        """插件卸载时停止后台任务与工作进程、移出排队任务、关闭会话并清理历史图片"""
+        for task in (self.warm_up_task, self.loop_monitor_task):
+            if task and not task.done():
+                task.cancel()
+        await self.job_queue.close()
+        if self.session and not self.session.closed:
+            await self.session.close()
+        if self.process_pool:
+            self.process_pool.shutdown(wait=False, cancel_futures=True)
+        for history in self.history.values():
+            for record in history:
+                record.remove_image()
+        self.history.clear()
+        self.result_index.clear()
+
     @command_group("sd")
     def sd(self):
         pass
@@ -344,58 +1867,182 @@ class SDGenerator(Star):
         try:
             webui_available, status = await self._check_webui_available()
             if webui_available:
-                yield event.plain_result("✅ 同Webui连接正常")
+                message = "✅ 同Webui连接正常"
             else:
-                yield event.plain_result(f"❌ 同Webui无连接，请检查配置和Webui工作状态")
+                message = f"❌ 同Webui无连接，请检查配置和Webui工作状态"
+            yield event.plain_result(f"{message}\n{self._get_warm_up_status()}\n\n{await self._get_load_status()}")
         except Exception as e:
             logger.error(f"❌ 检查可用性错误，报错{e}")
             yield event.plain_result("❌ 检查可用性错误，请检查日志")
 
-    async def _run_generate_image(
+    def _info_components(self, payload: dict, infos: list) -> list:
+        """按配置生成附在结果消息末尾的生成信息，随机种子时便于之后用 --seed 固定复现"""
+        mode = self.config.get("show_generation_info", "random_seed")
+        if mode == "never" or (mode == "random_seed" and payload["seed"] != -1):
+            return []
+        lines = [info.describe() for info in infos]
+        if not any(lines):
+            return []
+        if len(lines) == 1:
+            return [Plain(f"\n🎲 {lines[0]}")]
+        return [Plain("\n" + "\n".join(f"🎲 {i}. {line}" for i, line in enumerate(lines, start=1)))]
+
+    @staticmethod
+    def _event_lane(event: AstrMessageEvent) -> str:
+        """用户指令所属的优先级通道"""
+        return "admin" if event.is_admin() else "command"
+
+    @asynccontextmanager
+    async def _generation_slot(self, lane: str = "command"):
+        """按优先级通道占用一个并发生成槽位，并统计各通道的排队数与等待时间；产出可提前释放槽位的 release 函数"""
+        job_id = uuid.uuid4().hex
+        stats = self.lane_stats[lane]
+        self.queued_tasks += 1
+        stats["queued"] += 1
+        enqueued_at = time.monotonic()
+        try:
+            await self.job_queue.acquire(job_id, lane)
+        finally:
+            self.queued_tasks -= 1
+            stats["queued"] -= 1
+
+        waited = time.monotonic() - enqueued_at
+        stats["jobs"] += 1
+        stats["wait_max"] = max(stats["wait_max"], waited)
+        if stats["jobs"] == 1:
+            stats["wait_ewma"] = waited
+        else:
+            stats["wait_ewma"] += LATENCY_EWMA_ALPHA * (waited - stats["wait_ewma"])
+
+        self.active_tasks += 1
+        released = False
+
+        async def release():
+            """提前释放槽位（如放大改在本地进行时），重复调用无副作用"""
+            nonlocal released
+            if not released:
+                released = True
+                self.active_tasks -= 1
+                await self.job_queue.release(job_id)
+
+        try:
+            yield release
+        finally:
+            await release()
+
+    async def _generate_stage(
         self,
         event: AstrMessageEvent,
+        emit,
         prompt: str,
         allow_generate_prompt: bool,
-        allow_extract_prompt: bool
+        allow_extract_prompt: bool,
+        overrides: dict = None,
+        compose_prompt: bool = True,
+        init_image: str = None,
+        denoising_strength: float = None,
+        lane: str = None,
+        replay_overrides: dict = None
     ):
-        """Shared image generation logic for command/tool callers."""
-        async with self.task_semaphore:
-            self.active_tasks += 1
+        """生成阶段：只在出图期间占用并发槽位，结果通过 emit 交给发送阶段
+
+        lane 为准入调度的优先级通道，未指定时按发送者区分管理员与普通指令。
+        replay_overrides 为从历史记录还原的参数，不做范围检查，优先级低于 overrides。
+        """
+        try:
+            if allow_extract_prompt:
+                prompt = self._extract_prompt_from_message(event, prompt)
+                prompt, inline_overrides = self._parse_inline_overrides(prompt)
+                overrides = {**inline_overrides, **(overrides or {})}
+            else:
+                prompt = (prompt or "").strip()
+            params = self._resolve_generation_params({
+                **self._normalize_overrides(replay_overrides, check_ranges=False),
+                **self._normalize_overrides(overrides),
+            })
+        except ValueError as e:
+            emit(event.plain_result(f"⚠️ {e}"))
+            return
+        if not prompt:
+            emit(event.plain_result("⚠️ 需要提供提示词"))
+            return
+
+        # 高负载时逐级降低生成质量，避免积压无限增长
+        params, degradation_notes = self._apply_degradation(params)
+
+        # 按 GPU 成本扣除用户/群组配额，在占用并发槽位之前完成
+        cost = self._estimate_cost(params)
+        buckets = self._get_quota_buckets(event)
+        if any(cost > bucket.capacity for bucket in buckets):
+            emit(event.plain_result(f"❌ 本次生成预计成本 {cost:.1f} 超出单次配额上限，请降低分辨率、步数或数量"))
+            return
+        max_wait = self.config.get("quota", {}).get("max_wait_seconds", 0)
+        waited = 0.0
+        while (wait := self._reserve_quota(buckets, cost)) > 0:
+            if waited + wait > max_wait:
+                emit(event.plain_result(f"⏳ 算力配额不足（本次成本 {cost:.1f}），请在 {wait:.0f} 秒后重试"))
+                return
+            if waited == 0:
+                emit(event.plain_result(f"⏳ 算力配额不足，将在 {wait:.0f} 秒后开始生成"))
+            await asyncio.sleep(wait)
+            waited += wait
+
+        accepted_at = time.monotonic()
+        lane = lane or self._event_lane(event)
+        async with self._generation_slot(lane) as release_slot:
             try:
-                if allow_extract_prompt:
-                    prompt = self._extract_prompt_from_message(event, prompt)
-                else:
-                    prompt = (prompt or "").strip()
-                if not prompt:
-                    yield event.plain_result("⚠️ 需要提供提示词")
-                    return
                 # 检查webui可用性
                 if not (await self._check_webui_available())[0]:
-                    yield event.plain_result("⚠️ 同webui无连接，目前无法生成图片！")
+                    emit(event.plain_result("⚠️ 同webui无连接，目前无法生成图片！"))
                     return
 
                 verbose = self.config["verbose"]
                 if verbose:
-                    yield event.plain_result("🖌️ 生成图像阶段，这可能需要一段时间...")
+                    emit(event.plain_result("🖌️ 生成图像阶段，这可能需要一段时间..."))
 
-                # 生成正面提示词，决定到底是使用LLM生成还是用户直接提供
-                generated_prompt = ""
-                if allow_generate_prompt and self.config.get("enable_generate_prompt"):
-                    generated_prompt = await self._generate_prompt(prompt)
-                    logger.debug(f"LLM generated prompt: {generated_prompt}")
+                if compose_prompt:
+                    # 生成正面提示词，决定到底是使用LLM生成还是用户直接提供
+                    generated_prompt = ""
+                    if allow_generate_prompt and self.config.get("enable_generate_prompt"):
+                        generated_prompt = await self._generate_prompt(prompt)
+                        logger.debug(f"LLM generated prompt: {generated_prompt}")
 
-                positive_prompt = self._build_positive_prompt(prompt, generated_prompt)
+                    positive_prompt = self._build_positive_prompt(prompt, generated_prompt)
+                else:
+                    positive_prompt = prompt
 
                 #输出正面提示词
                 if self.config.get("enable_show_positive_prompt", False):
-                    yield event.plain_result(f"正面提示词：{positive_prompt}")
-
-                # 生成图像
-                response = await self._call_t2i_api(positive_prompt)
-                if not response.get("images"):
-                    raise ValueError("API返回数据异常：生成图像失败")
+                    tokens, chunks = self._analyze_prompt(positive_prompt)
+                    emit(event.plain_result(f"正面提示词：{positive_prompt}\n（{tokens} tokens，{chunks} 块）"))
+
+                # 生成图像，种子固定且参数相同的历史图片直接复用，不再占用 GPU
+                payload = await self._generate_payload(positive_prompt, params, init_image, denoising_strength)
+                response = None if init_image else await self._find_cached_result(payload)
+                if response:
+                    self.metrics["result_cache_hits"] += 1
+                    infos = response["infos"]
+                else:
+                    async with self._backend_admission(lane):
+                        if init_image:
+                            response = await self._call_i2i_api(payload)
+                        else:
+                            response = await self._call_t2i_api(payload)
+                    if not response.get("images"):
+                        raise ValueError("API返回数据异常：生成图像失败")
+                    info = await self._add_history(event, positive_prompt, payload, response)
+                    infos = [info.image(i) for i in range(len(response["images"]))]
+                    # 已产出图像，后续失败不再退还配额；命中缓存时配额在结束时退还
+                    buckets = []
+                    self._record_latency(time.monotonic() - accepted_at)
 
                 images = response["images"]
+                enable_upscale = params["enable_upscale"]
+
+                # 不需要 WebUI 放大时立即让出槽位，本地放大与发送不再阻塞其他任务出图
+                local_upscale = enable_upscale and await self._should_upscale_locally()
+                if not enable_upscale or local_upscale:
+                    await release_slot()
 
                 if len(images) == 1:
 
@@ -405,56 +2052,129 @@ class SDGenerator(Star):
                     image = base64.b64encode(image_bytes).decode("utf-8")
 
                     # 图像处理
-                    if self.config.get("enable_upscale"):
+                    if enable_upscale:
                         if verbose:
-                            yield event.plain_result("🖼️ 处理图像阶段，即将结束...")
-                        image = await self._apply_image_processing(image)
+                            emit(event.plain_result("🖼️ 处理图像阶段，即将结束..."))
+                        image = await self._apply_image_processing(image, local_upscale)
 
-                    yield event.chain_result([Image.fromBase64(image)])
+                    emit(event.chain_result([Image.fromBase64(image)] + self._info_components(payload, infos)))
                 else:
                     chain = []
 
-                    if self.config.get("enable_upscale") and verbose:
-                        yield event.plain_result("🖼️ 处理图像阶段，即将结束...")
+                    if enable_upscale and verbose:
+                        emit(event.plain_result("🖼️ 处理图像阶段，即将结束..."))
 
                     for image_data in images:
                         image_bytes = base64.b64decode(image_data)
                         image = base64.b64encode(image_bytes).decode("utf-8")
 
                         # 图像处理
-                        if self.config.get("enable_upscale"):
-                            image = await self._apply_image_processing(image)
+                        if enable_upscale:
+                            image = await self._apply_image_processing(image, local_upscale)
 
                         # 添加到链对象
                         chain.append(Image.fromBase64(image))
 
                     # 将链式结果发送给事件
-                    yield event.chain_result(chain)
+                    emit(event.chain_result(chain + self._info_components(payload, infos)))
+
+                if degradation_notes:
+                    emit(event.plain_result(f"⚙️ 当前负载较高，本次已自动降级：{'，'.join(degradation_notes)}"))
+
+                if params["draft"]:
+                    # 记录草稿，提升时沿用相同提示词、种子、底图与其他覆盖参数
+                    promote_overrides = {
+                        key: value for key, value in self._normalize_overrides(overrides).items()
+                        if key != "draft"
+                    }
+                    promote_overrides["seed"] = params["seed"]
+                    self.draft_records[event.unified_msg_origin] = {
+                        "prompt": positive_prompt,
+                        "overrides": promote_overrides,
+                        "replay_overrides": replay_overrides,
+                        "init_image": init_image,
+                        "denoising_strength": denoising_strength,
+                    }
+                    self.draft_records.move_to_end(event.unified_msg_origin)
+                    while len(self.draft_records) > MAX_DRAFT_SESSIONS:
+                        self.draft_records.popitem(last=False)
+                    emit(event.plain_result(
+                        f"📝 草稿已生成（种子 {params['seed']}），使用 /sd promote 以完整质量重新生成"
+                    ))
 
                 if verbose:
-                    yield event.plain_result("✅ 图像生成成功")
+                    emit(event.plain_result("✅ 图像生成成功"))
 
             except ValueError as e:
                 # 针对API返回异常的处理
                 logger.error(f"API返回数据异常: {e}")
-                yield event.plain_result(f"❌ 图像生成失败: 参数异常，API调用失败")
+                emit(event.plain_result(f"❌ 图像生成失败: 参数异常，API调用失败"))
 
             except ConnectionError as e:
                 # 网络连接错误处理
                 logger.error(f"网络连接失败: {e}")
-                yield event.plain_result("⚠️ 生成失败! 请检查网络连接和WebUI服务是否运行正常")
+                emit(event.plain_result("⚠️ 生成失败! 请检查网络连接和WebUI服务是否运行正常"))
 
             except TimeoutError as e:
                 # 处理超时错误
                 logger.error(f"请求超时: {e}")
-                yield event.plain_result("⚠️ 请求超时，请稍后再试")
+                emit(event.plain_result("⚠️ 请求超时，请稍后再试"))
 
             except Exception as e:
                 # 捕获所有其他异常
                 logger.error(f"生成图像时发生其他错误: {e}")
-                yield event.plain_result(f"❌ 图像生成失败: 发生其他错误，请检查日志")
+                emit(event.plain_result(f"❌ 图像生成失败: 发生其他错误，请检查日志"))
             finally:
-                self.active_tasks -= 1
+                for bucket in buckets:
+                    bucket.refund(cost)
+
+    async def _run_generate_image(
+        self,
+        event: AstrMessageEvent,
+        prompt: str,
+        allow_generate_prompt: bool,
+        allow_extract_prompt: bool,
+        overrides: dict = None,
+        compose_prompt: bool = True,
+        init_image: str = None,
+        denoising_strength: float = None,
+        lane: str = None,
+        replay_overrides: dict = None
+    ):
+        """Shared image generation logic for command/tool callers.
+
+        生成阶段在独立任务中运行，拿到图像后立即释放并发槽位；
+        发送阶段从输出队列取出结果，受单独的发送并发数限制，慢速的聊天平台不会占用 GPU 槽位。
+        """
+        outputs = asyncio.Queue()
+
+        async def generate():
+            try:
+                await self._generate_stage(
+                    event,
+                    outputs.put_nowait,
+                    prompt,
+                    allow_generate_prompt,
+                    allow_extract_prompt,
+                    overrides,
+                    compose_prompt,
+                    init_image,
+                    denoising_strength,
+                    lane,
+                    replay_overrides
+                )
+            finally:
+                outputs.put_nowait(None)
+
+        task = asyncio.create_task(generate())
+        try:
+            while (result := await outputs.get()) is not None:
+                async with self.delivery_semaphore:
+                    yield result
+            await task
+        finally:
+            if not task.done():
+                task.cancel()
 
     @sd.command("gen")  # 生成图像指令
     async def generate_image(self, event: AstrMessageEvent, prompt: str):
@@ -470,6 +2190,218 @@ class SDGenerator(Star):
         ):
             yield result
 
+    @sd.command("quota")  # 查看当前算力配额
+    async def show_quota(self, event: AstrMessageEvent):
+        """查看当前用户与群组剩余的算力配额"""
+        try:
+            buckets = self._get_quota_buckets(event)
+            if not buckets:
+                yield event.plain_result("📢 未启用算力配额限制")
+                return
+
+            cost = self._estimate_cost(self._resolve_generation_params())
+            names = ["用户", "群组"]
+            lines = [f"📊 按默认参数生成一次的成本: {cost:.1f}"]
+            for name, bucket in zip(names, buckets):
+                bucket.refill()
+                lines.append(
+                    f"- {name}配额: {max(bucket.tokens, 0):.1f}/{bucket.capacity:.1f}"
+                    f"（每分钟恢复 {bucket.refill_rate * 60:.1f}）"
+                )
+            yield event.plain_result("\n".join(lines))
+        except Exception as e:
+            logger.error(f"获取算力配额失败: {e}")
+            yield event.plain_result("❌ 获取算力配额失败，请检查日志")
+
+    @permission_type(PermissionType.ADMIN)
+    @sd.command("profile")  # 采样分析本插件在事件循环上的耗时热点
+    async def profile(self, event: AstrMessageEvent, seconds: int = 10):
+        """采样分析指定秒数内本插件占用事件循环的热点（仅管理员）"""
+        if seconds < 1 or seconds > 60:
+            yield event.plain_result("⚠️ 采样时长需设置在 1 到 60 秒之间")
+            return
+
+        yield event.plain_result(f"⏱️ 开始采样 {seconds} 秒...")
+        try:
+            hot_spots, samples = await asyncio.to_thread(
+                _sample_thread_stacks, threading.get_ident(), seconds, 0.005
+            )
+        except Exception as e:
+            logger.error(f"性能采样失败: {e}")
+            yield event.plain_result("❌ 性能采样失败，请检查日志")
+            return
+
+        busy = sum(hot_spots.values())
+        lines = [
+            f"📈 采样 {samples} 次，本插件占用事件循环 {busy / max(samples, 1):.1%}",
+            f"- 事件循环延迟: 平均 {self.loop_lag['ewma'] * 1000:.1f} ms，最大 {self.loop_lag['max'] * 1000:.1f} ms",
+        ]
+        for (location, leaf), count in hot_spots.most_common(10):
+            lines.append(f"- {count / samples:.1%} {location}（栈顶 {leaf}）")
+        if not hot_spots:
+            lines.append("- 采样期间本插件未占用事件循环")
+        yield event.plain_result("\n".join(lines))
+
+    @sd.command("promote")  # 以完整质量重新生成最近一次草稿
+    async def promote_draft(self, event: AstrMessageEvent):
+        """以相同种子和提示词，按完整质量重新生成本会话最近一次草稿"""
+        record = self.draft_records.get(event.unified_msg_origin)
+        if not record:
+            yield event.plain_result("⚠️ 当前会话没有可提升的草稿，请先使用 /sd gen --draft [提示词]")
+            return
+        self.draft_records.move_to_end(event.unified_msg_origin)
+
+        async for result in self._run_generate_image(
+            event,
+            record["prompt"],
+            allow_generate_prompt=False,
+            allow_extract_prompt=False,
+            overrides=record["overrides"],
+            compose_prompt=False,
+            init_image=record["init_image"],
+            denoising_strength=record["denoising_strength"],
+            replay_overrides=record["replay_overrides"]
+        ):
+            yield result
+
+    @sd.command("img2img")  # 以消息中的图片为底图生成图像
+    async def generate_img2img(self, event: AstrMessageEvent, prompt: str = ""):
+        """以消息中附带或引用的图片为底图生成图像
+        用法: /sd img2img [提示词] [--strength 0.6] [--size 768x512 ...]
+        """
+        try:
+            text = self._extract_prompt_from_message(event, prompt, subcommand="img2img")
+            tokens = text.split()
+            strength = None
+            if "--strength" in tokens:
+                position = tokens.index("--strength")
+                if position + 1 >= len(tokens):
+                    raise ValueError("参数 --strength 缺少取值")
+                strength = tokens[position + 1]
+                del tokens[position:position + 2]
+            text, overrides = self._parse_inline_overrides(" ".join(tokens))
+        except ValueError as e:
+            yield event.plain_result(f"⚠️ {e}")
+            return
+
+        async for result in self._run_img2img(event, text, overrides, strength, allow_generate_prompt=True):
+            yield result
+
+    @sd.command("history")  # 查看本会话的生成历史
+    async def show_history(self, event: AstrMessageEvent):
+        """查看本会话最近生成的图片"""
+        history = self.history.get(event.unified_msg_origin)
+        if not history:
+            yield event.plain_result("⚠️ 当前会话还没有生成过图片")
+            return
+
+        lines = []
+        for index, record in enumerate(reversed(history), start=1):
+            payload = record.payload
+            mode = "图生图" if "denoising_strength" in payload else "文生图"
+            lines.append(
+                f"{index}. [{mode} {payload['width']}x{payload['height']} 种子 {record.seed}] {record.prompt[:40]}"
+            )
+        yield event.plain_result("🕘 最近生成的图片（1 为最近一张）:\n" + "\n".join(lines))
+
+    @sd.command("again")  # 以相同种子重新生成历史图片
+    async def generate_again(self, event: AstrMessageEvent):
+        """以相同提示词和种子重新生成历史图片，可附加 --size 等单次生成参数
+        用法: /sd again [序号] [--size 1024x1024 ...]
+        """
+        try:
+            text = self._extract_prompt_from_message(event, "", subcommand="again")
+            text, overrides = self._parse_inline_overrides(text)
+            index = self._parse_history_index(text) if text else 1
+        except ValueError as e:
+            yield event.plain_result(f"⚠️ {e}")
+            return
+        record = self._get_history_record(event, index)
+        if record is None:
+            yield event.plain_result("⚠️ 没有对应的历史图片，请使用 /sd history 查看")
+            return
+
+        async for result in self._run_generate_image(
+            event,
+            record.prompt,
+            allow_generate_prompt=False,
+            allow_extract_prompt=False,
+            overrides=overrides,
+            replay_overrides=self._record_overrides(record),
+            compose_prompt=False
+        ):
+            yield result
+
+    @sd.command("vary")  # 基于历史图片生成变体
+    async def generate_variation(self, event: AstrMessageEvent, index: int = 1, strength: float = None):
+        """以历史图片为底图，通过图生图生成变体
+        Args:
+            index: 历史图片序号，1 为最近一张
+            strength: 重绘幅度（0-1），越大与原图差别越大
+        """
+        if strength is None:
+            strength = self.config.get("history", {}).get("vary_strength", 0.5)
+        try:
+            index = self._parse_history_index(index)
+            strength = self._parse_strength(strength)
+        except ValueError as e:
+            yield event.plain_result(f"⚠️ {e}")
+            return
+
+        record = self._get_history_record(event, index)
+        if record is None:
+            yield event.plain_result("⚠️ 没有对应的历史图片，请使用 /sd history 查看")
+            return
+
+        try:
+            init_image = await self._load_history_image(record)
+        except OSError as e:
+            logger.error(f"读取历史图片失败: {e}")
+            yield event.plain_result("❌ 历史图片已失效，请重新生成")
+            return
+
+        async for result in self._run_generate_image(
+            event,
+            record.prompt,
+            allow_generate_prompt=False,
+            allow_extract_prompt=False,
+            overrides={"seed": -1, "upscale": False},
+            replay_overrides=self._record_overrides(record),
+            compose_prompt=False,
+            init_image=init_image,
+            denoising_strength=strength
+        ):
+            yield result
+
+    async def _run_upscale_record(self, event: AstrMessageEvent, index: int):
+        """仅对历史图片执行放大，不重新生成"""
+        record = self._get_history_record(event, index)
+        if record is None:
+            yield event.plain_result("⚠️ 没有对应的历史图片，请使用 /sd history 查看")
+            return
+
+        try:
+            image = await self._load_history_image(record)
+            if await self._should_upscale_locally():
+                image = await self._apply_image_processing(image, local=True)
+            else:
+                if not (await self._check_webui_available())[0]:
+                    yield event.plain_result("⚠️ 同webui无连接，目前无法处理图片！")
+                    return
+
+                async with self._generation_slot(self._event_lane(event)):
+                    image = await self._apply_image_processing(image, local=False)
+            yield event.chain_result([Image.fromBase64(image)])
+        except OSError as e:
+            logger.error(f"读取历史图片失败: {e}")
+            yield event.plain_result("❌ 历史图片已失效，请重新生成")
+        except ConnectionError as e:
+            logger.error(f"网络连接失败: {e}")
+            yield event.plain_result("⚠️ 放大失败! 请检查网络连接和WebUI服务是否运行正常")
+        except Exception as e:
+            logger.error(f"放大历史图片时发生错误: {e}")
+            yield event.plain_result("❌ 放大失败: 发生其他错误，请检查日志")
+
     @sd.command("verbose")  # 切换详细输出模式
     async def set_verbose(self, event: AstrMessageEvent):
         """切换详细输出模式（verbose）"""
@@ -489,9 +2421,19 @@ class SDGenerator(Star):
             logger.error(f"切换详细输出模式失败: {e}")
             yield event.plain_result("❌ 切换详细模式失败，请检查日志")
 
-    @sd.command("upscale") # 切换图像增强模式
-    async def set_upscale(self, event: AstrMessageEvent):
-        """设置图像增强模式（enable_upscale）"""
+    @sd.command("upscale") # 切换图像增强模式，或放大历史图片
+    async def set_upscale(self, event: AstrMessageEvent, index: int = None):
+        """设置图像增强模式（enable_upscale），指定序号时仅放大该历史图片"""
+        if index is not None:
+            try:
+                index = self._parse_history_index(index)
+            except ValueError as e:
+                yield event.plain_result(f"⚠️ {e}")
+                return
+            async for result in self._run_upscale_record(event, index):
+                yield result
+            return
+
         try:
             # 获取当前的 upscale 配置值
             current_upscale = self.config.get("enable_upscale", False)
@@ -670,7 +2612,16 @@ class SDGenerator(Star):
             "",
             "📜 **主要功能指令**:",
             "- `/sd gen [提示词]`：生成图片，例如 `/sd gen 星空下的城堡`。",
-            "- `/sd check`：检查 WebUI 的连接状态。",
+            "- `/sd gen [提示词] --size 768x512 --steps 30 --seed 42 --batch 2 --sampler Euler~a --upscale/--no-upscale`：仅对本次生成生效的参数，不修改全局配置。",
+            "- `/sd gen --draft [提示词]`：以降低的分辨率和步数快速生成草稿预览。",
+            "- `/sd promote`：以相同种子按完整质量重新生成本会话最近一次草稿。",
+            "- `/sd quota`：查看当前用户与群组剩余的算力配额。",
+            "- `/sd img2img [提示词] [--strength 0.6]`：以消息中附带或引用的图片为底图生成图像，同样支持单次生成参数。",
+            "- `/sd history`：查看本会话最近生成的图片。",
+            "- `/sd again [序号] [--size 1024x1024 ...]`：以相同提示词和种子重新生成历史图片（默认最近一张），可附加单次生成参数。",
+            "- `/sd upscale [序号]`：仅放大历史图片，不重新生成。",
+            "- `/sd vary [序号] [重绘幅度]`：以历史图片为底图生成变体。",
+            "- `/sd check`：检查 WebUI 的连接状态，并显示当前负载与运行统计。",
             "- `/sd conf`：显示当前使用配置，包括模型、参数和提示词设置。",
             "- `/sd help`：显示本帮助信息。",
             "",
@@ -680,8 +2631,9 @@ class SDGenerator(Star):
             "- `/sd nprompt`： 设置生效的用户预设负面提示词（0，1，2，3）。",
             "",
             "🔧 **高级功能指令**:",
+            "- `/sd profile [秒数]`：（管理员）采样分析本插件在事件循环上的耗时热点，默认 10 秒。",
             "- `/sd verbose`：切换详细输出模式，用于实时告知目前AI生图进行到了哪个阶段。",
-            "- `/sd upscale`：切换图像增强模式（用于超分辨率放大或高分修复）。",
+            "- `/sd upscale`：不带序号时切换图像增强模式（用于超分辨率放大或高分修复）。",
             "- `/sd LLM`：开启后，在使用/sd gen指令时，将内容先发送给LLM，再由LLM来生成正面提示词",
             "- `/sd prompt`：开启时，用户发起AI生图请求后，将发送一条消息，内容为送入到Stable diffusion的正面提示词",
             "- `/sd timeout [秒数]`：设置连接超时时间（建议范围：10 到 1800 秒）。",
@@ -802,7 +2754,7 @@ class SDGenerator(Star):
         解析用户输入的索引，并设置对应的模型
         """
         try:
-            models = await self._get_sd_model_list()
+            models = await self._get_sd_model_list(use_cache=True)
             if not models:
                 yield event.plain_result("⚠️ 没有可用的模型")
                 return
@@ -868,7 +2820,7 @@ class SDGenerator(Star):
         设置采样器
         """
         try:
-            samplers = await self._get_sampler_list()
+            samplers = await self._get_sampler_list(use_cache=True)
             if not samplers:
                 yield event.plain_result("⚠️ 没有可用的采样器")
                 return
@@ -915,7 +2867,7 @@ class SDGenerator(Star):
         设置上采样算法
         """
         try:
-            upscalers = await self._get_upscaler_list()
+            upscalers = await self._get_upscaler_list(use_cache=True)
             if not upscalers:
                 yield event.plain_result("⚠️ 没有可用的上采样算法")
                 return
@@ -953,22 +2905,55 @@ class SDGenerator(Star):
             yield event.plain_result(f"获取 Embedding 模型列表失败: {str(e)}")
 
     @llm_tool("generate_image") # LLM可调用的图像生成工具函数
-    async def generate_image_tool(self, event: AstrMessageEvent, prompt: str):
+    async def generate_image_tool(
+        self,
+        event: AstrMessageEvent,
+        prompt: str,
+        width: int = None,
+        height: int = None,
+        steps: int = None,
+        seed: int = None,
+        batch_size: int = None,
+        sampler: str = None,
+        upscale: bool = None,
+        draft: bool = None
+    ):
         """Generate images using Stable Diffusion based on the given prompt.
         This function should only be called when the prompt contains keywords like "generate," "draw," or "create."
         It should not be mistakenly used for image searching.
         The prompt should be ready for Stable Diffusion; no additional prompt generation is performed.
+        All parameters except prompt are optional per-request overrides; omit them to use the configured defaults.
 
         Args:
             prompt (string): The prompt or description used for generating images.
+            width (number): Optional image width in pixels (1-2048).
+            height (number): Optional image height in pixels (1-2048).
+            steps (number): Optional sampling steps (10-50).
+            seed (number): Optional seed, -1 for random.
+            batch_size (number): Optional number of images to generate (1-10).
+            sampler (string): Optional sampler name, e.g. "Euler a".
+            upscale (boolean): Optional, whether to upscale the result.
+            draft (boolean): Optional, render a fast low-cost preview at reduced resolution and steps.
         """
+        overrides = {
+            "width": width,
+            "height": height,
+            "steps": steps,
+            "seed": seed,
+            "batch_size": batch_size,
+            "sampler": sampler,
+            "upscale": upscale,
+            "draft": draft,
+        }
         try:
             # 使用 async for 遍历异步生成器的返回值
             async for result in self._run_generate_image(
                 event,
                 prompt,
                 allow_generate_prompt=False,
-                allow_extract_prompt=False
+                allow_extract_prompt=False,
+                overrides=overrides,
+                lane="tool"
             ):
                 # 根据生成器的每一个结果返回响应
                 yield result
@@ -976,3 +2961,34 @@ class SDGenerator(Star):
         except Exception as e:
             logger.error(f"调用 generate_image 时出错: {e}")
             yield event.plain_result("❌ 图像生成失败，请检查日志")
+
+    @llm_tool("image_to_image") # LLM可调用的图生图工具函数
+    async def img2img_tool(
+        self,
+        event: AstrMessageEvent,
+        prompt: str,
+        strength: float = None,
+        width: int = None,
+        height: int = None,
+        steps: int = None,
+        seed: int = None
+    ):
+        """Redraw or edit the image attached to (or quoted by) the user's message using Stable Diffusion img2img.
+        Only call this when the user provides an image and asks to modify, restyle or redraw it.
+        The prompt should be ready for Stable Diffusion; no additional prompt generation is performed.
+
+        Args:
+            prompt (string): The prompt describing the desired result.
+            strength (number): Optional denoising strength between 0 and 1; higher values change the image more.
+            width (number): Optional output width in pixels (1-2048); defaults to the source aspect ratio.
+            height (number): Optional output height in pixels (1-2048); defaults to the source aspect ratio.
+            steps (number): Optional sampling steps (10-50).
+            seed (number): Optional seed, -1 for random.
+        """
+        overrides = {"width": width, "height": height, "steps": steps, "seed": seed}
+        try:
+            async for result in self._run_img2img(event, prompt, overrides, strength, allow_generate_prompt=False, lane="tool"):
+                yield result
+        except Exception as e:
+            logger.error(f"调用 image_to_image 时出错: {e}")
+            yield event.plain_result("❌ 图像生成失败，请检查日志")